@@ -0,0 +1,218 @@
+"""
+Benchmarks dropbox-snapshot.py against the local fake Dropbox API server.
+
+Every scenario serves a synthetic tree from this process and runs the
+script in a child process, so peak RSS is measured per run. The child
+loads the script as a module and routes all of its HTTPS requests to the
+fake server. A scenario can be run twice to measure a run with nothing
+to download. Results are printed as a table and can be written as JSON,
+to compare versions of the script:
+
+    python bench/bench.py wide tiny --latency 0.02 --json before.json
+    python bench/bench.py wide tiny --latency 0.02 --script ~/new/dropbox-snapshot.py --json after.json
+"""
+import sys, os, json, time, imp, glob, shutil, tempfile, argparse, subprocess, resource, datetime, collections
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_dropbox
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dropbox-snapshot.py')
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """ Sends https://<any Dropbox host>/... to the fake server instead. """
+    def __init__(self, port, **kwargs):
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+        self.port = port
+
+    def send(self, request, **kwargs):
+        request.url = 'http://127.0.0.1:%i/%s' % (self.port, request.url.split('/', 3)[3])
+        kwargs['verify'] = False
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+def local_session(port, pool_maxsize=8):
+    session = requests.Session()
+    session.mount('https://', LocalAdapter(port, pool_maxsize=pool_maxsize))
+    return session
+
+def peak_rss():
+    """ Returns the peak RSS of this process, in bytes.
+
+    ru_maxrss is not reset by exec on Linux, so a child would report the
+    memory of the server it was forked from. VmHWM is used where it exists. """
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def child(options):
+    """ Runs the script once in this process, then writes what it measured. """
+    import dropbox
+    port = options.port
+    dropbox.dropbox.pinned_session = lambda pool_maxsize=8: local_session(port, pool_maxsize)
+    ds = imp.load_source('dropbox_snapshot', options.script)
+    if hasattr(ds, 'http_session'):
+        sessions = {}
+        def http_session():
+            # One per thread, like the real one
+            import threading
+            key = threading.current_thread().ident
+            if not key in sessions:
+                sessions[key] = local_session(port)
+            return sessions[key]
+        ds.http_session = http_session
+    # Snapshots are named by the minute, a second run must not reuse the name
+    offset = datetime.timedelta(minutes=options.run)
+    class Clock(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.now(tz) + offset
+    ds.datetime = type('datetime', (), {'datetime': Clock})
+    sys.argv = ['dropbox-snapshot.py'] + options.script_args
+    start = time.time()
+    error = None
+    try:
+        ds.main()
+    except SystemExit as e:
+        if e.code:
+            error = 'exit %s' % e.code
+    except Exception as e:
+        error = '%s: %s' % (e.__class__.__name__, e)
+    result = {
+        'wall': time.time() - start,
+        'max_rss': peak_rss(),
+        'error': error,
+    }
+    for name in ['total_count', 'update_count', 'update_bytes', 'link_count', 'error_count']:
+        result[name] = getattr(ds, name, None)
+    snapshots = sorted(glob.glob(os.path.join(options.dir, 'snapshots', '*.metrics.json')))
+    if snapshots:
+        result['metrics'] = json.load(open(snapshots[-1]), object_pairs_hook=collections.OrderedDict)
+    json.dump(result, open(options.result, 'w'))
+
+def run_scenario(shape, options):
+    """ Serves one tree and runs the script against it, once or twice. """
+    tree = fake_dropbox.make_tree(shape, options.scale)
+    faults = fake_dropbox.Faults(options.latency, options.jitter, options.rate_limit, options.retry_after, options.errors, options.drops)
+    server = fake_dropbox.FakeDropbox(tree, faults).start()
+    work_dir = tempfile.mkdtemp(prefix='dsnap-bench-', dir=options.tmp)
+    results = []
+    try:
+        os.makedirs(os.path.join(work_dir, 'snapshots'))
+        open(os.path.join(work_dir, 'config.json'), 'w').write('{}')
+        open(os.path.join(work_dir, 'token.dat'), 'w').write('bench')
+        script_args = ['-c', os.path.join(work_dir, 'config.json'), '-f', os.path.join(work_dir, 'snapshots'),
+            '-l', os.path.join(work_dir, 'lockfile'), '-t', os.path.join(work_dir, 'token.dat')]
+        if options.workers:
+            script_args += ['-w', str(options.workers)]
+        script_args += options.script_args
+        for run in xrange(2 if options.twice else 1):
+            before = server.stats()
+            result_path = os.path.join(work_dir, 'result%i.json' % run)
+            command = [sys.executable, os.path.abspath(__file__), '--child', '--port', str(server.port),
+                '--dir', work_dir, '--run', str(run), '--result', result_path, '--script', options.script, '--'] + script_args
+            with open(os.path.join(work_dir, 'output%i.txt' % run), 'w') as output:
+                subprocess.call(command, stdout=output, stderr=subprocess.STDOUT)
+            if os.path.isfile(result_path):
+                result = json.load(open(result_path), object_pairs_hook=collections.OrderedDict)
+            else:
+                result = {'error': 'no result, see %s' % output.name}
+            after = server.stats()
+            result['shape'] = shape
+            result['run'] = 'full' if run == 0 else 'unchanged'
+            result['files'] = len(server.files)
+            result['bytes'] = sum(f.size for f in server.files.itervalues())
+            result['api_calls'] = after['api_calls'] - before['api_calls']
+            result['requests'] = dict((k, v - before['requests'].get(k, 0)) for k, v in after['requests'].iteritems())
+            result['faults'] = dict((k, v - before['faults'].get(k, 0)) for k, v in after['faults'].iteritems())
+            result['bytes_sent'] = after['bytes_sent'] - before['bytes_sent']
+            results.append(result)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.keep:
+            print 'Kept %s' % work_dir
+        else:
+            shutil.rmtree(work_dir, True)
+    return results
+
+def human_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(size) < 1024.0 or unit == 'GiB':
+            return '%.1f %s' % (size, unit)
+        size /= 1024.0
+
+def print_results(results):
+    phases = []
+    for result in results:
+        for phase in result.get('metrics', {}).get('phases', {}):
+            if not phase in phases:
+                phases.append(phase)
+    header = ['shape', 'run', 'files', 'wall s', 'files/s', 'MB/s', 'API calls', 'peak RSS'] + [phase + ' s' for phase in phases]
+    rows = []
+    for result in results:
+        wall = result.get('wall') or 0.0
+        row = [result['shape'], result['run'], str(result['files']), '%.2f' % wall,
+            '%.0f' % (result['files'] / wall if wall else 0.0),
+            '%.2f' % (result['bytes_sent'] / 1e6 / wall if wall else 0.0),
+            str(result['api_calls']), human_size(result.get('max_rss') or 0)]
+        for phase in phases:
+            seconds = result.get('metrics', {}).get('phases', {}).get(phase)
+            row.append('-' if seconds is None else '%.2f' % seconds)
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows + [header]) for i in xrange(len(header))]
+    for row in [header] + rows:
+        print '  '.join(cell.rjust(width) for cell, width in zip(row, widths))
+    for result in results:
+        if result.get('faults'):
+            print '%s/%s faults injected: %s' % (result['shape'], result['run'], ', '.join('%s %i' % item for item in sorted(result['faults'].iteritems())))
+        if result.get('error'):
+            print '%s/%s failed: %s' % (result['shape'], result['run'], result['error'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks dropbox-snapshot.py against a local fake Dropbox API server.",
+        usage="%(prog)s [options] [shapes ...] [-- script options ...]")
+    parser.add_argument("shapes", nargs='*', help="Trees to run: %s (default: all)" % ', '.join(fake_dropbox.SHAPES))
+    parser.add_argument("--scale", help="Multiplies the number of files or folders of every tree (default: 1)", type=float, default=1.0)
+    parser.add_argument("--script", help="Version of the script to run (default: the one next to bench/)", default=DEFAULT_SCRIPT)
+    parser.add_argument("-w", "--workers", help="Passed on as -w", type=int)
+    parser.add_argument("--twice", help="Run a second time, with nothing changed", action="store_true")
+    parser.add_argument("--latency", help="Seconds added to every request (default: 0)", type=float, default=0.0)
+    parser.add_argument("--jitter", help="Up to this many random seconds added to every request (default: 0)", type=float, default=0.0)
+    parser.add_argument("--rate_limit", help="Fraction of requests answered with 429 (default: 0)", type=float, default=0.0)
+    parser.add_argument("--retry_after", help="Seconds asked for by 429 responses (default: 1)", type=int, default=1)
+    parser.add_argument("--errors", help="Fraction of requests answered with 503 (default: 0)", type=float, default=0.0)
+    parser.add_argument("--drops", help="Fraction of downloads cut off halfway (default: 0)", type=float, default=0.0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--tmp", help="Where snapshots are written (default: the system temp folder)")
+    parser.add_argument("--keep", help="Keep the snapshots and output of every run", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS, action="store_true")
+    parser.add_argument("--port", help=argparse.SUPPRESS, type=int)
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    parser.add_argument("--run", help=argparse.SUPPRESS, type=int, default=0)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        # Everything after -- is passed on to the script
+        script_args = argv[argv.index('--')+1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+    options.script_args = script_args
+    if options.child:
+        return child(options)
+    for shape in options.shapes:
+        if not shape in fake_dropbox.SHAPES:
+            parser.error('Unknown shape: %s' % shape)
+    results = []
+    for shape in options.shapes or fake_dropbox.SHAPES:
+        results += run_scenario(shape, options)
+    print_results(results)
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=4)
+
+if __name__ == '__main__':
+    main()
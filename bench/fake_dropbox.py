@@ -0,0 +1,312 @@
+"""
+Local stand-in for the Dropbox v2 endpoints used by dropbox-snapshot.py.
+
+Serves a synthetic, read-only tree over plain HTTP. File contents are
+generated on the fly from a repeated 64 KiB pattern, so trees of any size
+cost almost no memory and their content_hash is cheap to compute. Latency,
+429 rate limits, 5xx errors and dropped connections can be injected.
+"""
+import json, time, random, hashlib, threading, zipfile, BaseHTTPServer, SocketServer
+from cStringIO import StringIO
+
+HASH_BLOCK_SIZE = 4*1024*1024
+PATTERN_SIZE = 64*1024
+SEND_CHUNK_SIZE = 1024*1024
+CLIENT_MODIFIED = '2020-01-01T00:00:00Z'
+
+SHAPES = ['wide', 'deep', 'tiny', 'huge']
+
+def make_tree(shape, scale=1.0):
+    """ Returns {path_display: size} for a synthetic tree, size is None for folders.
+
+    wide: one folder with many small files
+    deep: a long chain of nested folders with a few files each
+    tiny: many folders full of tiny files
+    huge: a few files large enough for ranged downloads """
+    tree = {}
+    def n(count):
+        return max(1, int(count * scale))
+    if shape == 'wide':
+        tree[u'/wide'] = None
+        for i in xrange(n(5000)):
+            tree[u'/wide/file%06i.dat' % i] = 1000 + i % 5000
+    elif shape == 'deep':
+        folder = u''
+        for depth in xrange(n(50)):
+            folder += u'/level%02i' % depth
+            tree[folder] = None
+            for i in xrange(20):
+                tree[folder + u'/file%02i.dat' % i] = 10000 + depth * 100 + i
+    elif shape == 'tiny':
+        for f in xrange(n(50)):
+            folder = u'/tiny/folder%03i' % f
+            tree[folder] = None
+            for i in xrange(200):
+                tree[folder + u'/t%04i' % i] = 10 + (f * 200 + i) % 200
+        tree[u'/tiny'] = None
+    elif shape == 'huge':
+        tree[u'/huge'] = None
+        for i in xrange(n(3)):
+            tree[u'/huge/big%02i.bin' % i] = 100*1024*1024 + i * 12345
+    else:
+        raise ValueError('Unknown shape: %s' % shape)
+    return tree
+
+class FakeFile:
+    """ Generated content of one file: a 64 KiB pattern seeded by its path, repeated. """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        seed = hashlib.sha256(path.encode('utf8')).digest()
+        self.pattern = (seed * (PATTERN_SIZE // len(seed) + 1))[:PATTERN_SIZE]
+        self.rev = hashlib.sha1(path.encode('utf8')).hexdigest()[:12]
+        self._content_hash = None
+
+    def read(self, offset, length):
+        data = []
+        while length > 0:
+            start = offset % PATTERN_SIZE
+            piece = self.pattern[start:start+length]
+            data.append(piece)
+            offset += len(piece)
+            length -= len(piece)
+        return ''.join(data)
+
+    @property
+    def content_hash(self):
+        # Every full 4 MiB block is the same pattern, so it is hashed once
+        if self._content_hash is None:
+            full_blocks, rest = divmod(self.size, HASH_BLOCK_SIZE)
+            digests = ''
+            if full_blocks:
+                digests = hashlib.sha256(self.read(0, HASH_BLOCK_SIZE)).digest() * full_blocks
+            if rest:
+                digests += hashlib.sha256(self.read(0, rest)).digest()
+            self._content_hash = hashlib.sha256(digests).hexdigest()
+        return self._content_hash
+
+class Faults:
+    """ What the server does wrong, each a probability per request except latency. """
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit=0.0, retry_after=1, errors=0.0, drops=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.errors = errors
+        self.drops = drops
+
+class FakeDropbox(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tree, faults=None, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.faults = faults or Faults()
+        self.folders = set()
+        self.files = {}
+        for path, size in tree.iteritems():
+            if size is None:
+                self.folders.add(path)
+            else:
+                self.files[path.lower()] = FakeFile(path, size)
+        self.folders = dict((path.lower(), path) for path in self.folders)
+        self.paths = sorted(self.folders.keys() + self.files.keys())
+        self.lock = threading.Lock()
+        self.requests = {} # endpoint -> count
+        self.faults_injected = {} # fault -> count
+        self.bytes_sent = 0
+        self.random = random.Random(0)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, table, key):
+        with self.lock:
+            table[key] = table.get(key, 0) + 1
+
+    def chance(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'api_calls': sum(self.requests.values()),
+                'faults': dict(self.faults_injected),
+                'bytes_sent': self.bytes_sent,
+            }
+
+    def metadata(self, path_lower):
+        if path_lower in self.folders:
+            path = self.folders[path_lower]
+            return {'.tag': 'folder', 'name': path.rsplit(u'/', 1)[1], 'id': 'id:' + hashlib.sha1(path_lower.encode('utf8')).hexdigest()[:22],
+                'path_lower': path_lower, 'path_display': path}
+        f = self.files[path_lower]
+        return {'.tag': 'file', 'name': f.path.rsplit(u'/', 1)[1], 'id': 'id:' + f.rev.ljust(22, '0'),
+            'path_lower': path_lower, 'path_display': f.path, 'client_modified': CLIENT_MODIFIED,
+            'server_modified': CLIENT_MODIFIED, 'rev': f.rev, 'size': f.size, 'content_hash': f.content_hash}
+
+    def under(self, path_lower):
+        """ Returns the paths below a folder, parents before their children. """
+        if not path_lower:
+            return self.paths
+        return [path for path in self.paths if path.startswith(path_lower + u'/')]
+
+    def resolve(self, path):
+        """ Maps a path or rev:... argument to a file. """
+        if path.startswith(u'rev:'):
+            for f in self.files.itervalues():
+                if f.rev == path[4:]:
+                    return f
+            return None
+        return self.files.get(path.lower())
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle would hold the body until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        endpoint = self.path.split('?')[0][len('/2/'):]
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.count(server.requests, endpoint)
+        faults = server.faults
+        if faults.latency or faults.jitter:
+            time.sleep(faults.latency + random.random() * faults.jitter)
+        # Account calls are made once, without retries, so they are never disturbed
+        if not endpoint.startswith('users/'):
+            if server.chance(faults.rate_limit):
+                server.count(server.faults_injected, 'rate_limit')
+                return self.send_json(429, {'error_summary': 'too_many_requests/',
+                    'error': {'reason': {'.tag': 'too_many_requests'}, 'retry_after': faults.retry_after}},
+                    {'Retry-After': str(faults.retry_after)})
+            if server.chance(faults.errors):
+                server.count(server.faults_injected, 'error')
+                return self.send_body(503, 'Service unavailable', 'text/plain')
+        if self.headers.get('Dropbox-API-Arg'):
+            arg = json.loads(self.headers['Dropbox-API-Arg'])
+        else:
+            arg = json.loads(body or '{}')
+        handler = getattr(self, 'route_' + endpoint.replace('/', '_'), None)
+        if handler is None:
+            return self.send_body(400, 'Unknown endpoint: ' + endpoint, 'text/plain')
+        handler(arg)
+
+    def send_body(self, code, body, content_type, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, data, headers={}):
+        self.send_body(code, json.dumps(data), 'application/json', headers)
+
+    def send_not_found(self, path):
+        self.send_json(409, {'error_summary': 'path/not_found/', 'error': {'.tag': 'path', 'path': {'.tag': 'not_found'}}})
+
+    def route_users_get_current_account(self, arg):
+        self.send_json(200, {
+            'account_id': 'dbid:' + 'A' * 35,
+            'name': {'given_name': 'Bench', 'surname': 'Mark', 'familiar_name': 'Bench', 'display_name': 'Bench Mark', 'abbreviated_name': 'BM'},
+            'email': 'bench@example.com', 'email_verified': True, 'disabled': False, 'locale': 'en',
+            'referral_link': 'https://db.tt/bench', 'is_paired': False, 'account_type': {'.tag': 'basic'},
+            'root_info': {'.tag': 'user', 'root_namespace_id': '1', 'home_namespace_id': '1'},
+        })
+
+    def route_users_get_space_usage(self, arg):
+        used = sum(f.size for f in self.server.files.itervalues())
+        self.send_json(200, {'used': used, 'allocation': {'.tag': 'individual', 'allocated': used * 2}})
+
+    def list_page(self, path_lower, offset, limit):
+        paths = self.server.under(path_lower)
+        page = paths[offset:offset+limit]
+        offset += len(page)
+        self.send_json(200, {
+            'entries': [self.server.metadata(path) for path in page],
+            'cursor': json.dumps([path_lower, offset]),
+            'has_more': offset < len(paths),
+        })
+
+    def route_files_list_folder(self, arg):
+        path_lower = arg.get('path', u'').lower()
+        if path_lower and not path_lower in self.server.folders:
+            return self.send_not_found(path_lower)
+        self.list_page(path_lower, 0, arg.get('limit') or 2000)
+
+    def route_files_list_folder_continue(self, arg):
+        # The tree never changes, a finished cursor returns no entries
+        path_lower, offset = json.loads(arg['cursor'])
+        self.list_page(path_lower, offset, 2000)
+
+    def route_files_download(self, arg):
+        f = self.server.resolve(arg['path'])
+        if f is None:
+            return self.send_not_found(arg['path'])
+        offset = 0
+        if self.headers.get('Range'):
+            offset = int(self.headers['Range'].split('=')[1].split('-')[0])
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(f.size - offset))
+        self.send_header('Dropbox-API-Result', json.dumps(self.server.metadata(f.path.lower())))
+        self.end_headers()
+        drop_at = None
+        if f.size - offset > 1 and self.server.chance(self.server.faults.drops):
+            self.server.count(self.server.faults_injected, 'drop')
+            drop_at = offset + (f.size - offset) // 2
+        while offset < f.size:
+            length = min(SEND_CHUNK_SIZE, f.size - offset)
+            if drop_at is not None:
+                length = min(length, drop_at - offset)
+            self.wfile.write(f.read(offset, length))
+            offset += length
+            with self.server.lock:
+                self.server.bytes_sent += length
+            if offset == drop_at:
+                self.wfile.flush()
+                self.close_connection = 1
+                self.connection.shutdown(2)
+                return
+
+    def route_files_download_zip(self, arg):
+        path_lower = arg['path'].lower()
+        if not path_lower in self.server.folders:
+            return self.send_not_found(path_lower)
+        parent = self.server.folders[path_lower].rsplit(u'/', 1)[0]
+        archive = StringIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            for path in self.server.under(path_lower):
+                if path in self.server.files:
+                    f = self.server.files[path]
+                    z.writestr(f.path[len(parent)+1:].encode('utf8'), f.read(0, f.size))
+        body = archive.getvalue()
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+        self.send_body(200, body, 'application/octet-stream',
+            {'Dropbox-API-Result': json.dumps({'metadata': self.server.metadata(path_lower)})})
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serves a synthetic Dropbox tree on localhost until interrupted.")
+    parser.add_argument("shape", choices=SHAPES)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    server = FakeDropbox(make_tree(args.shape, args.scale), address=('127.0.0.1', args.port))
+    print 'Serving %i files on http://127.0.0.1:%i' % (len(server.files), server.port)
+    server.serve_forever()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python2.7
 
 
-import sys, os, dropbox, time, argparse, json, datetime, subprocess, math, atexit, requests, logging, operator
-import errno
+import sys, os, dropbox, time, argparse, json, datetime, math, atexit, requests, logging
+import collections, threading, Queue, hashlib, sqlite3, calendar, shutil, random
+import errno, stat, tempfile, zipfile, heapq, signal, zlib, mmap, multiprocessing, re
 from pprint import pprint
 from functools import partial
 
@@ -14,9 +15,10 @@ default_config_path = '~/.dropbox-snapshot/config.json'
 default_token_path = '~/.dropbox-snapshot/token.dat'
 default_lockfile_path = '~/.dropbox-snapshot/lockfile'
 log_path = '~/.dropbox-snapshot/dsnapshot.log'
-DELAY = 0.00001
-API_RETRY_DELAY = 5
+API_RETRY_DELAY = 2
+API_RETRY_MAX_DELAY = 60
 API_RETRY_MAX = 5
+API_RATE_LIMIT_RETRY_MAX = 20
 total_count = 0
 update_count = 0
 update_bytes = 0
@@ -25,14 +27,85 @@ queue_bytes = 0
 checkpoint3 = False
 listed_bytes = 0
 space = 0
-time_prev = 0.0
-size_prev = 0.0
 job_size = 0
-speed = 0.0
+journal = None
+space_budget = None
 error_count = 0
+stats_lock = threading.Lock()
+compare_mode = 'hash'
+hash_cache = None
+dedup_index = None
+filters = None
+link_count = 0
+link_bytes = 0
+failed_parts = [] # .part files of ranged downloads that failed, removed once the snapshot is finished
+chunk_store = None # ChunkStore that downloads go to, for the chunks backend without a mirror
+access_token = None
+http_local = threading.local()
+CHUNKED_DOWNLOAD_SIZE = 64*1024*1024
+DOWNLOAD_CHUNK_SIZE = 4*1024*1024
+RENDER_INTERVAL = 0.5
+SPEED_WINDOW = 10.0
+API_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+ZIP_MAX_FILES = 10000 # Per folder, files_download_zip refuses more
+ZIP_MAX_SIZE = 1024*1024*1024
+ZIP_MIN_CHANGED = 0.5 # Fraction of a folder's bytes that must be downloaded anyway
+HASH_BLOCK_SIZE = 4*1024*1024
+LONGPOLL_TIMEOUT = 480 # The longest files_list_folder_longpoll allows, it adds up to 90 seconds of jitter
+DAEMON_MAX_DELAY = 3600 # Changes that keep coming in are snapshotted at least this often
+SNAPSHOT_FILES = ['.job', '.cursor', '.errors', '.metrics.json', '.deferred', '.manifest'] # Kept next to each snapshot
+SORT_CHUNK = 50000 # Items held in memory by an ExternalSort before they are spilled to disk
+CHUNKS_FOLDER = 'chunks' # Block store of the chunks backend, in the backup folder
+MIRROR_FOLDER = 'latest' # Latest state of the remote folders, kept by the chunks backend with --mirror
+VERIFY_INTERVAL = 30*24*3600 # Files that --verify checked more recently are not hashed again
+error_log_lock = threading.Lock()
 
 #logging.basicConfig(format='%(message)s')
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+if scandir is None:
+    class DirEntry:
+        """ Stand-in for os.DirEntry when the scandir module is not installed. """
+        def __init__(self, folder, name):
+            self.name = name
+            self.path = os.path.join(folder, name)
+            self._lstat = None
+
+        def stat(self, follow_symlinks=True):
+            if follow_symlinks:
+                return os.stat(self.path)
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+
+        def inode(self):
+            return self.stat(follow_symlinks=False).st_ino
+
+        def is_symlink(self):
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+        def is_dir(self, follow_symlinks=True):
+            try:
+                return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+            except OSError:
+                return False
+
+        def is_file(self, follow_symlinks=True):
+            try:
+                return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+            except OSError:
+                return False
+
+    def scandir(folder):
+        return [DirEntry(folder, name) for name in os.listdir(folder)]
+
 
 class Struct:
     def __init__(self, **entries): 
@@ -43,10 +116,16 @@ def abort():
     logging.warning( 'Files/folders scanned: %i' % total_count )
     logging.warning( 'Files/folders updated: %i' % update_count )
     logging.warning( 'Downloaded: %s' % human_size(update_bytes) )
+    logging.warning( rate_limiter.summary() )
+    if journal:
+        journal.close() # Keeps the completion records of an interrupted run
+    if metrics.prom_path:
+        write_metrics(False)
     #sys.exit(1)
 
 def disk_free(path):
-    return int(subprocess.Popen(['df', '-B', '1', path], stdout=subprocess.PIPE).communicate()[0].splitlines()[1].split()[3])
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
 
 def avg(list_of_numbers):
     sum = 0.0
@@ -106,58 +185,164 @@ def check_pid(pid):
         return True
 
 
+def unicode_path(path):
+    if isinstance(path, unicode):
+        return path
+    return path.decode('utf8')
+
 def expandstring(object):
     if type(object) is str:
         return os.path.abspath(os.path.expanduser(object))
     else:
         return object
 
+class RateLimiter:
+    """ Token bucket shared by all API calls, its rate grows after successes and is halved on rate limits. """
+    def __init__(self, rate=50.0, min_rate=0.5, max_rate=1000.0, increase=0.5, decrease=0.5):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.throttled = 0.0
+
+    def acquire(self):
+        """ Waits for a token. Tokens may go negative, which queues later callers. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(self.paused_until - now, 0.0)
+            if self.tokens < 1.0:
+                wait = max(wait, (1.0 - self.tokens) / self.rate)
+            self.tokens -= 1.0
+            self.calls += 1
+            self.throttled += wait
+        if wait:
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def limited(self, backoff):
+        """ Cuts the rate and pauses all callers for the backoff the server asked for. """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0.0)
+            self.paused_until = max(self.paused_until, time.time() + backoff)
+            self.rate_limited += 1
+            self.retries += 1
+
+    def backoff(self, attempt):
+        """ Sleeps before retrying a failed call: exponential backoff with full jitter. """
+        wait = random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_DELAY * 2 ** (attempt-1)))
+        with self.lock:
+            self.retries += 1
+            self.throttled += wait
+        time.sleep(wait)
+
+    def reset_stats(self):
+        """ Starts the counters from zero for a new run. The rate it has learned is kept. """
+        with self.lock:
+            self.calls = 0
+            self.retries = 0
+            self.rate_limited = 0
+            self.throttled = 0.0
+
+    def summary(self):
+        return 'API calls: %i, retries: %i, rate limited: %i, throttled: %s' % (
+            self.calls, self.retries, self.rate_limited, human_time(self.throttled))
+
+rate_limiter = RateLimiter()
+
+class Metrics:
+    """ Phase durations, API latencies and throughput samples for the run metrics. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+        self.phase = None
+        self.phase_started = None
+        self.latency = {} # endpoint -> [count per bucket..., count above the last bucket]
+        self.latency_sum = collections.defaultdict(float)
+        self.outcomes = collections.defaultdict(int) # (endpoint, outcome) -> count
+        self.throughput = [] # Bytes per second, sampled while downloading
+        self.json_path = None
+        self.prom_path = None
+
+    def start_phase(self, name):
+        """ Ends the current phase and starts the next one, None ends the last. """
+        now = time.time()
+        with self.lock:
+            if self.phase:
+                self.phases[self.phase] = self.phases.get(self.phase, 0.0) + now - self.phase_started
+            self.phase = name
+            self.phase_started = now
+
+    def observe_api(self, endpoint, seconds, outcome):
+        with self.lock:
+            if not endpoint in self.latency:
+                self.latency[endpoint] = [0] * (len(API_LATENCY_BUCKETS) + 1)
+            i = 0
+            while i < len(API_LATENCY_BUCKETS) and seconds > API_LATENCY_BUCKETS[i]:
+                i += 1
+            self.latency[endpoint][i] += 1
+            self.latency_sum[endpoint] += seconds
+            self.outcomes[(endpoint, outcome)] += 1
+
+    def sample_throughput(self, bytes_per_second):
+        with self.lock:
+            self.throughput.append(bytes_per_second)
+
+    def percentile(self, fraction):
+        with self.lock:
+            samples = sorted(self.throughput)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples)-1, int(fraction * len(samples)))]
+
+metrics = Metrics()
+
 def api_call(fun, *args, **kwargs):
-    global DELAY, API_RETRY_DELAY, API_RETRY_MAX
+    endpoint = getattr(fun, '__name__', fun.__class__.__name__)
     attempt = 0
-    time.sleep(DELAY)
-    done = False
-    while not done and attempt < API_RETRY_MAX:
+    rate_limited = 0
+    while True:
         attempt += 1
+        rate_limiter.acquire()
+        start = time.time()
         try:
             response = fun(*args, **kwargs)
-            done = True
-        except dropbox.exceptions.InternalServerError as e:
-            request_id, status_code, body = e
-            if attempt >= API_RETRY_MAX:
-                #logging.error(  'There is an issue with the Dropbox server. Aborted after %i attempts.' % attempt )
-                #logging.error( str(e) )
-                raise
-            time.sleep(API_RETRY_DELAY)
-        except requests.exceptions.ReadTimeout as e:
-            if attempt >= API_RETRY_MAX:
-                # logging.error(   'Could not receive data from server. Aborted after %i attempts.' % attempt )
-                # logging.error( str(e) )
-                raise
-            time.sleep(API_RETRY_DELAY)
-        except requests.exceptions.ConnectionError as e:
-            if attempt >= API_RETRY_MAX:
-                # logging.error(   'Connection error. Aborted after %i attempts.' % attempt )
-                # logging.error( str(e) )
-                raise
-            time.sleep(API_RETRY_DELAY)
+            metrics.observe_api(endpoint, time.time() - start, 'ok')
+            rate_limiter.success()
+            return response
         except dropbox.exceptions.RateLimitError as e:
-            request_id, error, backoff = e
-            time.sleep(backoff)
-            DELAY *= 1.1
-            if attempt >= API_RETRY_MAX:
+            metrics.observe_api(endpoint, time.time() - start, 'rate_limited')
+            rate_limited += 1
+            if rate_limited >= API_RATE_LIMIT_RETRY_MAX:
                 # logging.error(   'Rate limit error. Aborted after %i attempts.' % attempt )
-                # logging.error( str(e) )
                 raise
-        except dropbox.exceptions.ApiError as e:
-            if attempt >= 0:
-                # logging.error(   'API Error. Aborted after %i attempts.' % attempt )
+            attempt -= 1 # Rate limits do not count as failed attempts
+            rate_limiter.limited(e.backoff or API_RETRY_DELAY)
+        except (dropbox.exceptions.InternalServerError, requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
+            if attempt >= API_RETRY_MAX:
+                metrics.observe_api(endpoint, time.time() - start, 'error')
+                # logging.error(   'Aborted after %i attempts.' % attempt )
                 # logging.error( str(e) )
                 raise
-            time.sleep(API_RETRY_DELAY)
+            metrics.observe_api(endpoint, time.time() - start, 'retry')
+            rate_limiter.backoff(attempt)
         except:
+            metrics.observe_api(endpoint, time.time() - start, 'error')
             raise
-    return response
 
 def authorize():
     logging.warning(    'New Dropbox API token is required' )
@@ -177,6 +362,7 @@ def authorize():
     return access_token
 
 def login(token_save_path):
+    global access_token
     if os.path.exists(token_save_path):
         with open(token_save_path) as token_file:
             access_token = token_file.read()
@@ -184,142 +370,2866 @@ def login(token_save_path):
         access_token = authorize()
         with open(token_save_path, 'w') as token_file:
             token_file.write(access_token)
-    return dropbox.Dropbox(access_token)
-
-def compare_folder(dbx, remote_folder, local_folder, job_path):
-    remote_folder = remote_folder.rstrip(u'/') + u'/'
-    global update_count, total_count, update_bytes, queue_bytes, listed_bytes, local_files
-    status(remote_folder.encode('utf8'))
-    if remote_folder == '/':
-        remote_list = api_call(dbx.files_list_folder, '').entries
-    else:
-        remote_list = api_call(dbx.files_list_folder, remote_folder).entries
-    jobs = []
-    total_count += 1
-    if not os.path.isdir(local_folder):
-        jobs.append(u'+ '+remote_folder)
+    # Retries are left to api_call, so the rate limiter sees every error
+    return dropbox.Dropbox(access_token, max_retries_on_error=0, max_retries_on_rate_limit=0)
+
+LIST_LIMIT = 2000
+
+class ExternalSort:
+    """ Sorts (key, value) pairs in files in spool_folder, equal keys keep their order. """
+    def __init__(self, spool_folder, chunk_size=SORT_CHUNK):
+        self.spool_folder = spool_folder
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.chunks = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key, value=None):
+        self.buffer.append((key, self.count, value))
+        self.count += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.spill()
+
+    def spill(self):
+        # The last chunk is spilled too, so every key has been through JSON and compares alike
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        chunk = tempfile.TemporaryFile(dir=self.spool_folder)
+        for item in self.buffer:
+            chunk.write(json.dumps(item, separators=(',', ':')) + '\n')
+        chunk.seek(0)
+        self.chunks.append(chunk)
+        self.buffer = []
+
+    def __iter__(self):
+        """ Yields every (key, value) in key order, then frees the temporary files. """
+        self.spill()
+        try:
+            for key, count, value in heapq.merge(*[(json.loads(line) for line in chunk) for chunk in self.chunks]):
+                yield key, value
+        finally:
+            for chunk in self.chunks:
+                chunk.close()
+            self.chunks = []
+
+class SortedIds:
+    """ Tells whether an id is in a sorted stream of ids, for ids asked in ascending order. """
+    def __init__(self, ids):
+        self.ids = iter(ids)
+        self.current = next(self.ids, None)
+
+    def __contains__(self, id):
+        while self.current is not None and self.current < id:
+            self.current = next(self.ids, None)
+        return self.current == id
+
+class DiskMap:
+    """ The part of a dict that DedupIndex uses, kept in a temporary SQLite database. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect('', check_same_thread=False)
+        self.connection.execute('CREATE TABLE map (key BLOB PRIMARY KEY, value TEXT)')
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO map VALUES (?, ?)', (buffer(key), value))
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM map WHERE key = ?', (buffer(key),)).fetchone()
+        return row[0] if row else default
+
+RemoteFile = collections.namedtuple('RemoteFile', 'name size client_modified content_hash rev')
+
+class RemoteTree:
+    """ Folder names of a recursive remote listing, to rebuild the case of display paths. """
+    def __init__(self, remote_folder):
+        self.root = remote_folder.rstrip(u'/') + u'/'
+        self.root_lower = self.root.rstrip(u'/').lower()
+        self.names = {} # folder path_lower -> folder name, as shown by its own entry
+
+    def add(self, entry):
+        if entry.path_lower != self.root_lower and isinstance(entry, dropbox.files.FolderMetadata):
+            self.names[entry.path_lower] = entry.name
+
+    def display_path(self, folder_lower):
+        """ Returns the remote path of a folder, with a trailing slash. """
+        parts = []
+        while folder_lower != self.root_lower:
+            parent_lower, name_lower = folder_lower.rsplit(u'/', 1)
+            parts.append(self.names.get(folder_lower, name_lower))
+            folder_lower = parent_lower
+        parts.append(self.root.rstrip(u'/'))
+        return u'/'.join(reversed(parts)) + u'/'
+
+class SortedRemoteTree:
+    """ Recursive remote listing sorted on disk, walked one folder at a time. """
+    FOLDER, CHILD, FILE = 0, 1, 2
+
+    def __init__(self, remote_folder, spool_folder):
+        self.root = remote_folder.rstrip(u'/') + u'/'
+        self.root_lower = self.root.rstrip(u'/').lower()
+        self.entries = ExternalSort(spool_folder)
+        self.entries.add(self.key(self.root_lower, self.FOLDER))
+        self.cursor = None
+
+    @staticmethod
+    def key(folder_lower, kind, name_lower=u''):
+        # With the separator sorting first, a folder's subfolders come right after it
+        return [folder_lower.replace(u'/', u'\x00'), kind, name_lower]
+
+    def add(self, entry):
+        if entry.path_lower == self.root_lower:
+            return
+        parent_lower, name_lower = entry.path_lower.rsplit(u'/', 1)
+        if isinstance(entry, dropbox.files.FolderMetadata):
+            self.entries.add(self.key(entry.path_lower, self.FOLDER), entry.name)
+            self.entries.add(self.key(parent_lower, self.CHILD, name_lower), entry.name)
+        elif isinstance(entry, dropbox.files.FileMetadata):
+            self.entries.add(self.key(parent_lower, self.FILE, name_lower), [entry.name, entry.size,
+                entry.client_modified.strftime('%Y-%m-%dT%H:%M:%SZ'), entry.content_hash, entry.rev])
+
+    def walk(self):
+        """ Yields (remote_folder, child_folder_names, files) for every folder, parents first. """
+        stack = [] # (path_lower, remote_folder) of the current folder and those above it
+        folder = None
+        for (folder_key, kind, name_lower), value in self.entries:
+            folder_lower = folder_key.replace(u'\x00', u'/')
+            if kind == self.FOLDER:
+                if folder:
+                    yield folder
+                while stack and not folder_lower.startswith(stack[-1][0] + u'/'):
+                    stack.pop()
+                if stack:
+                    parent_lower, parent_folder = stack[-1]
+                    # Folders missing from the listing keep their lowercase name
+                    missing = folder_lower[len(parent_lower)+1:].split(u'/')[:-1]
+                    remote_folder = parent_folder + u''.join(name + u'/' for name in missing) + value + u'/'
+                else:
+                    remote_folder = self.root
+                stack.append((folder_lower, remote_folder))
+                folder = (remote_folder, [], [])
+            elif folder and folder_lower == stack[-1][0]:
+                if kind == self.CHILD:
+                    folder[1].append(value)
+                else:
+                    name, size, client_modified, content_hash, rev = value
+                    client_modified = datetime.datetime.strptime(client_modified, '%Y-%m-%dT%H:%M:%SZ')
+                    folder[2].append(RemoteFile(name, size, client_modified, content_hash, rev))
+        if folder:
+            yield folder
+
+class Filters:
+    """ Include, exclude, max_size and own rules, applied to every entry as it is listed. """
+    def __init__(self, include=(), exclude=(), max_size=0, not_owned=()):
+        self.include = self.compile([self.translate(pattern) for pattern in include])
+        parents = []
+        for pattern in include:
+            parents += self.parents(pattern)
+        self.include_parents = self.compile(parents, subtree=False)
+        self.exclude = self.compile([self.translate(pattern) for pattern in exclude])
+        self.max_size = max_size*1024*1024
+        self.not_owned = set(not_owned)
+        self.skipped = 0
+
+    @staticmethod
+    def compile(expressions, subtree=True):
+        if not expressions:
+            return None
+        return re.compile(u'^(?:%s)%s$' % (u'|'.join(expressions), u'(?:/.*)?' if subtree else u''), re.UNICODE)
+
+    @staticmethod
+    def translate(pattern):
+        """ Returns a regular expression for the lowercase remote paths a glob matches. """
+        pattern = pattern.lower().rstrip(u'/')
+        if u'/' in pattern:
+            regex = u''
+            pattern = u'/' + pattern.lstrip(u'/')
+        else:
+            regex = u'/(?:.*/)?'
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith(u'**/', i):
+                regex += u'(?:.*/)?'
+                i += 3
+            elif pattern.startswith(u'**', i):
+                regex += u'.*'
+                i += 2
+            elif pattern[i] == u'*':
+                regex += u'[^/]*'
+                i += 1
+            elif pattern[i] == u'?':
+                regex += u'[^/]'
+                i += 1
+            elif pattern[i] == u'[' and pattern.find(u']', i+2) > 0:
+                end = pattern.find(u']', i+2)
+                chars = pattern[i+1:end]
+                if chars.startswith(u'!'):
+                    chars = u'^' + chars[1:]
+                regex += u'[' + chars.replace(u'\\', u'\\\\') + u']'
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex
+
+    @staticmethod
+    def parents(pattern):
+        """ Returns regular expressions for the folders that lead to what an include glob matches. """
+        segments = pattern.strip(u'/').split(u'/')
+        if len(segments) == 1:
+            return [u'.*'] # Matches a name at any depth
+        expressions = []
+        for i in xrange(1, len(segments)):
+            if u'**' in segments[i-1]:
+                expressions.append(Filters.translate(u'/' + u'/'.join(segments[:i-1])) + u'(?:/.*)?' if i > 1 else u'.*')
+                break
+            expressions.append(Filters.translate(u'/' + u'/'.join(segments[:i])))
+        return expressions
+
+    def wanted(self, entry):
+        """ Returns whether a listed entry is kept. Deleted entries are only checked against the excludes. """
+        path_lower = entry.path_lower
+        if self.exclude and self.exclude.match(path_lower):
+            return False
+        if isinstance(entry, dropbox.files.DeletedMetadata):
+            return True
+        if self.include and not self.include.match(path_lower):
+            if not isinstance(entry, dropbox.files.FolderMetadata) or not self.include_parents.match(path_lower):
+                return False
+        if self.max_size and isinstance(entry, dropbox.files.FileMetadata) and entry.size > self.max_size:
+            return False
+        sharing_info = getattr(entry, 'sharing_info', None)
+        if self.not_owned and sharing_info is not None:
+            if (getattr(sharing_info, 'shared_folder_id', None) or sharing_info.parent_shared_folder_id) in self.not_owned:
+                return False
+        return True
+
+    def filter(self, entries):
+        """ Yields the entries that are kept, counting the others. """
+        for entry in entries:
+            if self.wanted(entry):
+                yield entry
+            else:
+                self.skipped += 1
+
+    @staticmethod
+    def settings(config):
+        """ Returns the rules of a config as stored with the cursors, or None without rules. """
+        if not config.include and not config.exclude and not config.max_size and not config.own:
+            return None
+        return {'include': config.include, 'exclude': config.exclude, 'max_size': config.max_size, 'own': config.own}
+
+def not_owned_folders(dbx):
+    """ Returns the ids of the shared folders the current user is a member of, but does not own. """
+    ids = set()
+    result = api_call(dbx.sharing_list_folders, limit=1000)
+    while True:
+        for folder in result.entries:
+            if not folder.access_type.is_owner():
+                ids.add(folder.shared_folder_id)
+        if not result.cursor:
+            return ids
+        result = api_call(dbx.sharing_list_folders_continue, result.cursor)
+
+def list_folder_pages(dbx, remote_folder, cursor=None):
+    """ Yields every page of a recursive listing, following has_more. """
+    if cursor is None:
+        path = remote_folder.rstrip(u'/')
+        result = api_call(dbx.files_list_folder, path, recursive=True, limit=LIST_LIMIT)
     else:
-        jobs.append(u'  '+remote_folder)
-    #print repr(job_path)
-    #print repr(jobs)
-    open(job_path, 'a').write((u'\n'.join(jobs)+u'\n').encode('utf8'))
-    jobs_dict = {}
-    #print repr(remote_list)
-    #print repr(remote_list)
+        result = api_call(dbx.files_list_folder_continue, cursor)
+    yield result
+    while result.has_more:
+        result = api_call(dbx.files_list_folder_continue, result.cursor)
+        yield result
+
+class CursorReset(Exception):
+    """ Raised by list_changes when the cursor was reset and a full scan is needed. """
+
+def list_changes(dbx, remote_folder, cursor=None):
+    """ Yields each page of a listing with the entries the filters keep, but the remote folder itself. """
+    root_lower = remote_folder.rstrip(u'/').lower()
     try:
-        local_folder_index = os.listdir(local_folder)
-    except OSError as e:
-        local_folder_index = []
-    for item in sorted(remote_list):
-        #print repr(item.name.encode('utf8'))
-        remote_path = remote_folder+item.name
-        is_folder = type(item) == dropbox.files.FolderMetadata
-        local_file_path = (local_folder+u'/'+item.name).replace('//', '/')
-        if item.name in local_folder_index:
-            local_folder_index.remove(item.name)
-        if is_folder:
-            compare_folder(dbx, remote_path, local_file_path, job_path) # Because recursive list_folder does not show correct case for parent folders :(
+        # A reset cursor fails on the first page, before anything is planned
+        for page in list_folder_pages(dbx, remote_folder, cursor):
+            entries = []
+            for entry in page.entries:
+                if entry.path_lower == root_lower:
+                    continue
+                if not filters.wanted(entry):
+                    filters.skipped += 1
+                    if cursor is None or isinstance(entry, dropbox.files.DeletedMetadata):
+                        continue
+                    # Removed from the snapshot, in case it was kept before it changed
+                    entry = dropbox.files.DeletedMetadata(name=entry.name, path_lower=entry.path_lower, path_display=entry.path_display)
+                entries.append(entry)
+            yield page, entries
+    except dropbox.exceptions.ApiError as e:
+        if cursor is not None and isinstance(e.error, dropbox.files.ListFolderContinueError) and e.error.is_reset():
+            logging.warning( 'Cursor for %s was reset, falling back to a full scan' % remote_folder.encode('utf8') )
+            raise CursorReset()
+        raise
+
+def deferred_files(deferred, root_lower, changed):
+    """ Yields (remote_path, RemoteFile) for the deferred journal entries below root_lower that are still wanted. """
+    for entry in deferred:
+        # Still wanted unless it, or a folder above it, has changed since
+        path_lower = entry['path'].lower()
+        parents = [path_lower] + [folder.rstrip(u'/') for folder in parent_folders(path_lower)]
+        if not path_lower.startswith(root_lower + u'/') or [p for p in parents if p in changed]:
+            continue
+        client_modified = datetime.datetime.strptime(entry['mtime'], '%Y-%m-%dT%H:%M:%SZ')
+        yield entry['path'], RemoteFile(entry['path'].rsplit(u'/', 1)[1], entry['size'], client_modified, entry['hash'], entry['rev'])
+
+def list_remote_tree(dbx, remote_folder, spool_folder):
+    """ Lists remote_folder recursively into a SortedRemoteTree. """
+    global total_count
+    tree = SortedRemoteTree(remote_folder, spool_folder)
+    for page in list_folder_pages(dbx, remote_folder):
+        for entry in filters.filter(page.entries):
+            tree.add(entry)
+        total_count += len(page.entries)
+        status(remote_folder.encode('utf8') + ' (%i entries listed)' % total_count)
+        tree.cursor = page.cursor
+    return tree
+
+class ContentHasher:
+    """ Computes content_hash the way Dropbox does, from data fed in pieces of any size. """
+    def __init__(self):
+        self.block_hashes = hashlib.sha256()
+        self.block = hashlib.sha256()
+        self.block_pos = 0
+
+    def update(self, data):
+        offset = 0
+        while offset < len(data):
+            piece = data[offset:offset+HASH_BLOCK_SIZE-self.block_pos]
+            self.block.update(piece)
+            self.block_pos += len(piece)
+            offset += len(piece)
+            if self.block_pos == HASH_BLOCK_SIZE:
+                self.block_hashes.update(self.block.digest())
+                self.block = hashlib.sha256()
+                self.block_pos = 0
+
+    def hexdigest(self):
+        block_hashes = self.block_hashes.copy()
+        if self.block_pos:
+            block_hashes.update(self.block.digest())
+        return block_hashes.hexdigest()
+
+def content_hash(local_file_path):
+    hasher = ContentHasher()
+    with open(local_file_path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def hash_file_mapped(local_file_path):
+    """ Returns (local_file_path, content_hash, error), reading the file through mmap. """
+    try:
+        with open(local_file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            block_hashes = hashlib.sha256()
+            if size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, size, HASH_BLOCK_SIZE):
+                        block_hashes.update(hashlib.sha256(buffer(data, offset, HASH_BLOCK_SIZE)).digest())
+                finally:
+                    data.close()
+        return local_file_path, block_hashes.hexdigest(), None
+    except (IOError, OSError, mmap.error) as e:
+        return local_file_path, None, str(e)
+
+def hash_block(block_path):
+    """ Returns (block_path, SHA-256 of the block data, error). Runs in the --verify process pool. """
+    try:
+        return block_path, hashlib.sha256(ChunkStore.read(block_path)).hexdigest(), None
+    except (IOError, OSError, zlib.error) as e:
+        return block_path, None, str(e)
+
+class HashCache:
+    """ Persistent content_hash cache keyed by device, inode, size and mtime. """
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, inode INTEGER, size INTEGER, mtime REAL, content_hash TEXT, PRIMARY KEY (dev, inode))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS verified (dev INTEGER, inode INTEGER, size INTEGER, mtime REAL, content_hash TEXT, verified REAL, PRIMARY KEY (dev, inode))')
+        self.pending = 0
+        self.hashed = 0
+
+    def get(self, local_file_path, st=None):
+        """ Returns the content_hash of a file, hashing it only if the cache is stale. """
+        if st is None:
+            st = os.stat(local_file_path)
+        file_hash = self.lookup(st)
+        if file_hash:
+            return file_hash
+        file_hash = content_hash(local_file_path)
+        self.hashed += 1
+        self.put(st, file_hash)
+        return file_hash
+
+    def lookup(self, st):
+        """ Returns the cached content_hash for a stat result, or None. Never hashes. """
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, content_hash FROM hashes WHERE dev = ? AND inode = ?', (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return row[2]
+        return None
+
+    def put(self, st, file_hash):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', (st.st_dev, st.st_ino, st.st_size, st.st_mtime, file_hash))
+            self.pending += 1
+            if self.pending >= self.COMMIT_INTERVAL:
+                self.connection.commit()
+                self.pending = 0
+
+    def verified(self, st, since):
+        """ Returns the content_hash a file was verified to have after since, or None if it changed since. """
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, content_hash, verified FROM verified WHERE dev = ? AND inode = ?', (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime and row[3] >= since:
+            return row[2]
+        return None
+
+    def put_verified(self, st, file_hash):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?)', (st.st_dev, st.st_ino, st.st_size, st.st_mtime, file_hash, time.time()))
+        self.put(st, file_hash)
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class DedupIndex:
+    """ Maps content_hash to a local file, or to the blocks of a chunks snapshot, with that content. """
+    def __init__(self, snapshot_incomplete, snapshot_previous, on_disk=False, snapshots=()):
+        self.snapshot_incomplete = unicode_path(snapshot_incomplete) if snapshot_incomplete else None
+        self.snapshot_previous = unicode_path(snapshot_previous) if snapshot_previous else None
+        self.sources = DiskMap() if on_disk else {}
+        self.manifests = []
+        for snapshot in snapshots:
+            manifest = Manifest.open(snapshot)
+            if manifest:
+                self.manifests.append((unicode_path(snapshot), manifest))
+
+    def add(self, file_hash, local_file_path):
+        if file_hash:
+            key = file_hash.decode('hex')
+            if not key in self.sources:
+                self.sources[key] = local_file_path
+
+    def get(self, file_hash):
+        if not file_hash:
+            return None
+        source = self.sources.get(file_hash.decode('hex'))
+        if source is None:
+            source = self.find(file_hash)
+        return source
+
+    def find(self, file_hash):
+        """ Returns a file of a snapshot with this content_hash, or its blocks, from its manifest. """
+        for snapshot, manifest in self.manifests:
+            blocks = manifest.blocks_of(file_hash)
+            if blocks is not None:
+                return blocks
+            for path in manifest.find(file_hash):
+                source = snapshot + path
+                if os.path.isfile(source):
+                    return source
+        return None
+
+    def close(self):
+        for snapshot, manifest in self.manifests:
+            manifest.close()
+
+    def add_removed(self, local_path):
+        """ Indexes a file, or every file in a folder, by its cached hash before the run removes it. """
+        if not self.snapshot_previous or not local_path.startswith(self.snapshot_incomplete):
+            return
+        previous_path = self.snapshot_previous + local_path[len(self.snapshot_incomplete):]
+        if os.path.isdir(local_path):
+            for folder, dirnames, filenames in os.walk(local_path):
+                for name in filenames:
+                    local_file_path = os.path.join(folder, name)
+                    self.add_cached(local_file_path, previous_path + local_file_path[len(local_path):])
         else:
-            total_count += 1
-            #logging.debug( u'[R] ' + remote_path )
-            modified = False
-            if not os.path.isfile(local_file_path):
-                modified = True
-            else:
-                mtime = os.path.getmtime(local_file_path)
-                mtime_dt = datetime.datetime(*time.gmtime(mtime)[:6])
-                size = os.path.getsize(local_file_path)
-                if mtime_dt != item.client_modified and size != item.size:
-                    modified = True
-            if modified:
-                #logging.info( '[L] Added to download queue: ' + local_file_path )
-                jobs_dict[remote_path+' %i' % item.size] = '+'
+            self.add_cached(local_path, previous_path)
+
+    def add_cached(self, local_file_path, source):
+        try:
+            st = os.lstat(local_file_path)
+        except OSError:
+            return
+        if stat.S_ISREG(st.st_mode):
+            self.add(hash_cache.lookup(st), source)
+
+def link_file(source, local_file_path):
+    """ Hardlinks source to local_file_path, or copies it where hardlinks are not possible. """
+    try:
+        os.link(source, local_file_path)
+    except OSError as e:
+        if not e.errno in [errno.EXDEV, errno.EMLINK, errno.EPERM]:
+            raise
+        shutil.copy2(source, local_file_path)
+
+class TreeWalk:
+    """ Walks directory trees on a pool of threads, handle(task) returns the subfolders to walk. """
+    def __init__(self, handle, workers):
+        self.handle = handle
+        self.workers = workers
+
+    def run(self, tasks):
+        self.tasks = Queue.Queue()
+        self.pending = len(tasks)
+        self.lock = threading.Lock()
+        self.error = None
+        if not tasks:
+            return
+        for task in tasks:
+            self.tasks.put(task)
+        threads = []
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.0)
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            subtasks = []
+            if not self.error:
+                try:
+                    subtasks = self.handle(task)
+                except:
+                    self.error = sys.exc_info()
+            with self.lock:
+                self.pending += len(subtasks) - 1
+                for subtask in subtasks:
+                    self.tasks.put(subtask)
+                if self.pending == 0:
+                    for i in xrange(self.workers):
+                        self.tasks.put(None)
+
+class SnapshotFS:
+    """ Hardlink snapshot operations done in-process with scandir, on a pool of threads. """
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.folders = 0
+        self.removed = 0
+
+    def clone(self, source, target, subtrees=[u'/']):
+        """ Recreates the given subtrees of source under target, hardlinking every file. """
+        source = unicode_path(source).rstrip(u'/')
+        target = unicode_path(target).rstrip(u'/')
+        roots = []
+        for subtree in sorted(set(subtrees)):
+            subtree = subtree.rstrip(u'/')
+            if [root for root in roots if (subtree+u'/').startswith(root+u'/')]:
+                continue # Already included in a parent subtree
+            if os.path.isdir(source + subtree):
+                roots.append(subtree)
+        tasks = []
+        for root in roots:
+            if not os.path.isdir(target + root):
+                os.makedirs(target + root)
+            tasks.append((source + root, target + root))
+        TreeWalk(self.clone_folder, self.workers).run(tasks)
+
+    def clone_folder(self, task):
+        source, target = task
+        subtasks = []
+        linked = 0
+        for entry in scandir(source):
+            target_path = os.path.join(target, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target_path)
+            elif entry.is_dir(follow_symlinks=False):
+                os.mkdir(target_path)
+                os.chmod(target_path, stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode))
+                subtasks.append((entry.path, target_path))
             else:
-                jobs_dict[remote_path+' %i' % item.size] = ' '
-            listed_bytes += item.size
-    for deleted in local_folder_index:
-        deleted_path = os.path.join(local_folder, deleted)
-        remote_path = remote_folder+unicode(deleted)
-        #print '\n' + repr(deleted_path)
-        if os.path.isdir(deleted_path):
-            jobs_dict[remote_path+u'/'] = '-'
+                os.link(entry.path, target_path)
+                linked += 1
+        with self.lock:
+            self.linked += linked
+            self.folders += 1
+        return subtasks
+
+    def remove(self, path):
+        """ Removes a file or a whole folder tree. """
+        path = unicode_path(path)
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.remove(path)
+            with self.lock:
+                self.removed += 1
+            return
+        folders = []
+        def remove_files(folder):
+            subfolders = []
+            removed = 0
+            for entry in scandir(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                else:
+                    os.remove(entry.path)
+                    removed += 1
+            with self.lock:
+                folders.append(folder)
+                self.removed += removed
+            return subfolders
+        TreeWalk(remove_files, self.workers).run([path])
+        for folder in sorted(folders, key=len, reverse=True): # Children before their parents
+            os.rmdir(folder)
+        with self.lock:
+            self.removed += len(folders)
+
+class Pruner(threading.Thread):
+    """ Removes expired snapshots in the background while the run goes on. """
+    def __init__(self, paths, workers):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.paths = paths
+        self.fs = SnapshotFS(workers)
+        self.elapsed = 0.0
+        self.error = None
+
+    def run(self):
+        start = time.time()
+        for path in self.paths:
+            logging.info( 'Removing old snapshot: ' + path.encode('utf8') )
+            try:
+                self.fs.remove(path)
+            except (IOError, OSError) as e:
+                self.error = e
+                logging.error( 'Could not remove %s: %s' % (path.encode('utf8'), e) )
+        self.elapsed = time.time() - start
+
+    def summary(self):
+        return 'Removed old snapshots (%i files/folders) in %s' % (self.fs.removed, human_time(self.elapsed))
+
+def set_mtime(local_file_path, client_modified):
+    mtime = calendar.timegm(client_modified.utctimetuple())
+    os.utime(local_file_path, (mtime, mtime))
+
+def is_modified(local_file_path, item, st=None):
+    if st is None:
+        st = os.stat(local_file_path)
+    if st.st_size != item.size:
+        return True
+    if compare_mode == 'hash':
+        return hash_cache.get(local_file_path, st) != item.content_hash
+    mtime_dt = datetime.datetime(*time.gmtime(st.st_mtime)[:6])
+    return mtime_dt != item.client_modified
+
+class JobJournal:
+    """ Append-only .job file in JSON lines: a header, plan lines, and a done line per finished action. """
+    VERSION = 1
+    FLUSH_LINES = 1000
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.flushed = time.time()
+        self.next_id = 0
+        self.listener = None # Called with every plan record, to act on it at once
+        self.file = open(path, 'ab')
+        if self.file.tell():
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    self.file.write('\n')
+
+    def header(self, **fields):
+        fields['version'] = self.VERSION
+        self.write(fields)
+
+    def plan(self, op, path, item=None):
+        """ Adds an action: op is '+', '-', 'u' or ' ' (unchanged), folder paths end with a slash. """
+        record = {'id': self.next_id, 'op': op, 'path': path}
+        if item is not None:
+            record['size'] = item.size
+            record['hash'] = item.content_hash
+            record['rev'] = item.rev
+            record['mtime'] = item.client_modified.strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.next_id += 1
+        self.write(record)
+        if self.listener:
+            self.listener(record)
+        return record['id']
+
+    def done(self, job_id, blocks=None):
+        record = {'done': job_id}
+        if blocks is not None:
+            record['blocks'] = blocks
+        self.write(record)
+
+    def scan(self, remote_folder):
+        self.write({'scan': remote_folder})
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, separators=(',', ':')))
+            if len(self.buffer) >= self.FLUSH_LINES or time.time() - self.flushed > self.FLUSH_INTERVAL:
+                self._flush(sync=True)
+
+    def flush(self, sync=False):
+        with self.lock:
+            self._flush(sync)
+
+    def _flush(self, sync):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.flushed = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._flush(sync=True)
+                self.file.close()
+
+    @staticmethod
+    def read(path):
+        """ Yields every record of a job file, checking its version first. """
+        with open(path, 'rb') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if line.strip():
+                        logging.warning( 'Skipped unreadable line %i in %s' % (i+1, path) )
+                    continue
+                if i == 0 and record.get('version') != JobJournal.VERSION:
+                    raise ValueError('Unsupported job file version in %s: %s' % (path, record.get('version')))
+                yield record
+
+    @staticmethod
+    def replay(path, spool_folder=None):
+        """ Returns the header, the finished ids, the plan records and the scanned folders of a .job. """
+        header = {}
+        done = ExternalSort(spool_folder) if spool_folder else set()
+        scanned = []
+        for record in JobJournal.read(path):
+            if 'version' in record:
+                header = record
+            elif 'done' in record:
+                done.add(record['done'])
+            elif 'scan' in record:
+                scanned.append(record['scan'])
+        if spool_folder:
+            # Looked up in ascending order, the order of the plan records
+            done = SortedIds(key for key, value in done)
+        plan = (record for record in JobJournal.read(path) if 'op' in record)
+        return header, done, plan, scanned
+
+def read_cursors(snapshot):
+    """ Returns the list_folder cursors of a snapshot that completed without errors. """
+    if not snapshot or snapshot.endswith('.incomplete'):
+        return {}
+    error_log_path = snapshot+'.errors'
+    if os.path.isfile(error_log_path) and os.path.getsize(error_log_path) > 0:
+        return {}
+    try:
+        return json.load(open(snapshot+'.cursor'))
+    except (IOError, ValueError):
+        return {}
+
+def local_index(folder):
+    """ Returns {name: stat} for the entries of a local folder, or None if it does not exist. """
+    index = {}
+    try:
+        entries = scandir(folder)
+    except OSError as e:
+        if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+            return None
+        return index
+    for entry in entries:
+        try:
+            try:
+                index[entry.name] = entry.stat()
+            except OSError:
+                index[entry.name] = entry.stat(follow_symlinks=False)
+        except OSError: # Removed while listing
+            pass
+    return index
+
+class LocalIndexer:
+    """ Indexes local folders on a pool of threads, ahead of the compare. """
+    PREFETCH_MAX = 1000
+
+    def __init__(self, workers):
+        self.tasks = Queue.Queue()
+        self.results = {}
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def prefetch(self, folder):
+        with self.condition:
+            if folder in self.pending or folder in self.results:
+                return
+            if len(self.pending) + len(self.results) >= self.PREFETCH_MAX:
+                return
+            self.pending.add(folder)
+        self.tasks.put(folder)
+
+    def work(self):
+        while True:
+            folder = self.tasks.get()
+            if folder is None:
+                return
+            try:
+                result = (local_index(folder), None)
+            except:
+                result = (None, sys.exc_info())
+            with self.condition:
+                self.pending.discard(folder)
+                self.results[folder] = result
+                self.condition.notify_all()
+
+    def get(self, folder):
+        with self.condition:
+            while folder in self.pending:
+                self.condition.wait(1.0)
+            if folder in self.results:
+                index, error = self.results.pop(folder)
+                if error:
+                    raise error[0], error[1], error[2]
+                return index
+        return local_index(folder)
+
+    def close(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+
+def compare_delta(dbx, remote_folder, local_folder, cursor, deferred=()):
+    """ Plans the job for remote_folder from the changes since cursor. Returns None if the cursor was reset. """
+    global total_count, listed_bytes
+    root = remote_folder.rstrip(u'/')
+    root_lower = root.lower()
+    local_root = local_folder.rstrip(u'/')
+    names = {} # folder path_lower -> folder name, as shown by its own entry
+    changed = set()
+    removed = set() # path_lower of what is planned for removal, later changes find it gone
+    local_names = {}
+    def local_name(local_folder, name_lower):
+        if not local_folder in local_names:
+            try:
+                local_names[local_folder] = dict((name.lower(), name) for name in os.listdir(local_folder))
+            except OSError:
+                local_names[local_folder] = {}
+        return local_names[local_folder].get(name_lower)
+    def resolve(entry):
+        # Changes show the case of their parents as unreliably as recursive listings,
+        # so each component is taken from its own folder entry or the local snapshot.
+        parts_lower = entry.path_lower[len(root_lower):].split(u'/')[1:]
+        parts_display = entry.path_display.split(u'/')[-len(parts_lower):]
+        path = u''
+        for i, part_lower in enumerate(parts_lower):
+            path_lower = root_lower + u'/' + u'/'.join(parts_lower[:i+1])
+            name = names.get(path_lower)
+            if name is None and (i < len(parts_lower)-1 or isinstance(entry, dropbox.files.DeletedMetadata)):
+                name = local_name(local_root+path, part_lower)
+            if name is None:
+                name = entry.name if i == len(parts_lower)-1 else parts_display[i]
+            path += u'/' + name
+        return path
+    def plan_change(entry):
+        global listed_bytes
+        path = resolve(entry)
+        remote_path = root + path
+        local_path = local_root + path
+        gone = entry.path_lower in removed or [folder for folder in parent_folders(entry.path_lower) if folder.rstrip(u'/') in removed]
+        if isinstance(entry, dropbox.files.FolderMetadata):
+            if gone or not os.path.isdir(local_path):
+                journal.plan('+', remote_path+u'/')
+        elif isinstance(entry, dropbox.files.FileMetadata):
+            listed_bytes += entry.size
+            if gone or not os.path.isfile(local_path):
+                journal.plan('+', remote_path, entry)
+            elif is_modified(local_path, entry):
+                dedup_index.add_removed(local_path)
+                journal.plan('u', remote_path, entry)
+        elif gone:
+            pass
+        elif os.path.isdir(local_path):
+            dedup_index.add_removed(local_path)
+            journal.plan('-', remote_path+u'/')
+            removed.add(entry.path_lower)
+        elif os.path.lexists(local_path):
+            dedup_index.add_removed(local_path)
+            journal.plan('-', remote_path)
+            removed.add(entry.path_lower)
+    try:
+        for page, entries in list_changes(dbx, remote_folder, cursor):
+            for entry in entries:
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    names[entry.path_lower] = entry.name
+                changed.add(entry.path_lower)
+                plan_change(entry)
+            total_count += len(page.entries)
+            status(remote_folder.encode('utf8') + ' (%i changes listed)' % len(changed))
+            cursor = page.cursor
+    except CursorReset:
+        return None
+    plan = []
+    for remote_path, item in deferred_files(deferred, root_lower, changed):
+        if os.path.isfile(local_root + remote_path[len(root):]):
+            continue
+        listed_bytes += item.size
+        plan.append((remote_path, '+', item))
+    for remote_path, op, entry in sorted(plan):
+        journal.plan(op, remote_path, entry)
+    return cursor
+
+def compare_folder(dbx, remote_folder, local_folder, workers, spool_folder=None):
+    """ Plans the job for remote_folder from a full listing. """
+    global total_count
+    local_root = local_folder.rstrip(u'/')
+    indexer = LocalIndexer(workers)
+    def local_path(remote_path_folder):
+        return local_root + remote_path_folder[len(remote_folder.rstrip(u'/')):].rstrip(u'/')
+    def open_folder(remote_path_folder):
+        # Returns (remote_path_folder, local_folder, local entries not listed so far)
+        local_folder = local_path(remote_path_folder)
+        local_folder_index = indexer.get(local_folder)
+        if local_folder_index is None:
+            journal.plan('+', remote_path_folder)
+            local_folder_index = {}
+        else:
+            journal.plan(' ', remote_path_folder)
+        return remote_path_folder, local_folder, local_folder_index
+    def plan_file(folder, item):
+        global listed_bytes
+        remote_path_folder, local_folder, local_folder_index = folder
+        remote_path = remote_path_folder+item.name
+        local_file_path = local_folder+u'/'+item.name
+        st = local_folder_index.pop(item.name, None)
+        if st is None or not stat.S_ISREG(st.st_mode):
+            journal.plan('+', remote_path, item)
+        elif is_modified(local_file_path, item, st):
+            # Replaced rather than overwritten, the old file is hardlinked to previous snapshots
+            dedup_index.add_removed(local_file_path)
+            journal.plan('u', remote_path, item)
         else:
-            jobs_dict[remote_path+u' 0'] = '-'
-    del(local_folder_index)
-    jobs = []
-    for j in sorted(jobs_dict):
-        jobs.append(jobs_dict[j]+' '+j)
-    jobs_dict = {}
-    open(job_path, 'a').write((u'\n'.join(jobs)+u'\n').encode('utf8'))
+            journal.plan(' ', remote_path, item)
+        listed_bytes += item.size
+    def plan_deletions(folder):
+        remote_path_folder, local_folder, local_folder_index = folder
+        for deleted, st in sorted(local_folder_index.iteritems()):
+            deleted_path = os.path.join(local_folder, deleted)
+            remote_path = remote_path_folder+unicode(deleted)
+            dedup_index.add_removed(deleted_path)
+            if stat.S_ISDIR(st.st_mode):
+                journal.plan('-', remote_path+u'/')
+            else:
+                journal.plan('-', remote_path)
+    journal.scan(remote_folder)
+    try:
+        indexer.prefetch(local_root)
+        if spool_folder:
+            tree = list_remote_tree(dbx, remote_folder, spool_folder)
+            for remote_path_folder, child_names, remote_files in tree.walk():
+                folder = open_folder(remote_path_folder)
+                for name in child_names:
+                    folder[2].pop(name, None)
+                for item in remote_files:
+                    plan_file(folder, item)
+                plan_deletions(folder)
+                status(remote_path_folder.encode('utf8'))
+            return tree.cursor
+        tree = RemoteTree(remote_folder)
+        folders = {} # path_lower -> open_folder() of every folder planned so far
+        def get_folder(folder_lower):
+            if not folder_lower in folders:
+                if folder_lower != tree.root_lower:
+                    # Opened with its parent, for folders missing from the listing
+                    parent = get_folder(folder_lower.rsplit(u'/', 1)[0])
+                    parent[2].pop(tree.names.get(folder_lower, folder_lower.rsplit(u'/', 1)[1]), None)
+                folders[folder_lower] = open_folder(tree.display_path(folder_lower))
+            return folders[folder_lower]
+        def plan_page(entries):
+            for entry in entries:
+                if entry.path_lower == tree.root_lower:
+                    continue
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    get_folder(entry.path_lower)
+                elif isinstance(entry, dropbox.files.FileMetadata):
+                    plan_file(get_folder(entry.path_lower.rsplit(u'/', 1)[0]), RemoteFile(
+                        entry.name, entry.size, entry.client_modified, entry.content_hash, entry.rev))
+        cursor = None
+        previous_page = []
+        for page in list_folder_pages(dbx, remote_folder):
+            entries = list(filters.filter(page.entries))
+            for entry in entries:
+                tree.add(entry)
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    indexer.prefetch(local_path(tree.display_path(entry.path_lower)))
+            plan_page(previous_page)
+            previous_page = entries
+            total_count += len(page.entries)
+            status(remote_folder.encode('utf8') + ' (%i entries listed)' % total_count)
+            cursor = page.cursor
+        plan_page(previous_page)
+        get_folder(tree.root_lower) # An empty remote folder
+        for folder_lower in sorted(folders):
+            plan_deletions(folders[folder_lower])
+        return cursor
+    finally:
+        indexer.close()
+
+def compare_manifest(dbx, remote_folder, manifest, cursor=None, deferred=()):
+    """ Plans the job for remote_folder against the manifest of the previous chunks snapshot. """
+    global total_count, listed_bytes
+    root_lower = remote_folder.rstrip(u'/').lower()
+    names = {} # folder path_lower -> folder name, as shown by its own entry
+    changed = set()
+    def display_path(entry):
+        # The case of the parents is taken from their own entries where they were listed
+        parts_lower = entry.path_lower.split(u'/')
+        parts = entry.path_display.split(u'/')
+        for i in xrange(1, len(parts)-1):
+            parts[i] = names.get(u'/'.join(parts_lower[:i+1]), parts[i])
+        parts[-1] = entry.name
+        return u'/'.join(parts)
+    if cursor is None:
+        journal.scan(remote_folder)
+        deferred = () # Listed anyway
+    try:
+        for page, entries in list_changes(dbx, remote_folder, cursor):
+            for entry in entries:
+                if cursor is not None:
+                    changed.add(entry.path_lower)
+                if isinstance(entry, dropbox.files.FolderMetadata):
+                    names[entry.path_lower] = entry.name
+                    continue
+                path = display_path(entry)
+                row = manifest.get(path) if manifest else None
+                if isinstance(entry, dropbox.files.FileMetadata):
+                    listed_bytes += entry.size
+                    if row is None:
+                        journal.plan('+', path, entry)
+                    elif row[0] != path or row[1] != entry.size or row[4] != entry.content_hash:
+                        journal.plan('u', path, entry)
+                    elif cursor is None:
+                        journal.plan(' ', path, entry)
+                elif manifest and manifest.has_folder(path):
+                    journal.plan('-', path + u'/')
+                elif row:
+                    journal.plan('-', path)
+            total_count += len(page.entries)
+            status(remote_folder.encode('utf8') + ' (%i entries listed)' % total_count)
+            new_cursor = page.cursor
+    except CursorReset:
+        return compare_manifest(dbx, remote_folder, manifest)
+    for remote_path, item in deferred_files(deferred, root_lower, changed):
+        listed_bytes += item.size
+        journal.plan('+', remote_path, item)
+    return new_cursor
 
 def clear_line():
     sys.stdout.write("\033[K")
     sys.stdout.flush()
 
-def status(msg=' '):
-    global space, listed_bytes, update_bytes, job_size, free_space, time_prev, size_prev, speed, error_count, checkpoint4, etl
-    clear_line()
-    if listed_bytes < space:
-        progress_compare = float(listed_bytes) / float(space)
-        progress_compare *= 100.0
-        print '\rComparing: %5.2f%% ' % progress_compare + msg,
-    else:
-        progress_download = float(update_bytes) / float(job_size)
-        time_now = time.time()
-        size_now = float(update_bytes)
-        if time_now - time_prev > 2.0:
-            speed = (size_now - size_prev) / (time_now - time_prev)
-            size_log = [(time.time(), update_bytes)]
-            time_prev = time_now + 0.0
-            size_prev = size_now + 0.0
-            if progress_download == 0.0:
-                etl = ''
+class ProgressRenderer(threading.Thread):
+    """ Redraws the status line at a fixed rate and samples the download throughput. """
+    def __init__(self, interval=RENDER_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.message = ' '
+        self.current = None
+        self.speed_samples = collections.deque() # (time, update_bytes)
+        self.last_sample = None
+
+    def phase(self, name):
+        """ Switches the line being drawn and starts timing the phase. """
+        with self.lock:
+            self.current = name
+            self.message = ' '
+            self.speed_samples.clear()
+            self.last_sample = None
+        metrics.start_phase(name)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                self.render()
+
+    def render(self):
+        now = time.time()
+        if self.current == 'compare':
+            if 0 < listed_bytes < space:
+                line = 'Comparing: %5.2f%% ' % (100.0 * listed_bytes / space)
             else:
-                etl = human_time(( ( time_now - checkpoint4 ) / progress_download) * ( 1.0 - progress_download ))
-        print '\rTotal delta: %s %5.2f%% Speed: %sps ETL: %s' % (human_size(job_size), progress_download * 100.0, human_size(speed), etl) + msg,
+                line = 'Comparing: %s listed ' % human_size(listed_bytes)
+        elif self.current in ['download', 'link']:
+            self.sample(now)
+            progress_download = 1.0
+            if job_size:
+                progress_download = min(1.0, float(update_bytes) / float(job_size))
+            speed = 0.0
+            if len(self.speed_samples) > 1:
+                (t0, b0), (t1, b1) = self.speed_samples[0], self.speed_samples[-1]
+                speed = (b1 - b0) / max(t1 - t0, 0.001)
+            etl = ''
+            if 0.0 < progress_download < 1.0:
+                etl = human_time(( ( now - metrics.phase_started ) / progress_download) * ( 1.0 - progress_download ))
+            line = 'Total delta: %s %5.2f%% Speed: %sps ETL: %s ' % (human_size(job_size), progress_download * 100.0, human_size(speed), etl)
+        else:
+            return
+        clear_line()
+        sys.stdout.write('\r' + line + self.message)
+        sys.stdout.flush()
 
-def download_file(dbx, local_file_path, remote_path, size, skip_existing=False):
-    global update_count, total_count, update_bytes, queue_bytes, error_log_path, error_count
-    #clear_line()
-    if skip_existing and os.path.isfile(local_file_path):
-        status(remote_path.encode('utf8')+' already exists')
+    def sample(self, now):
+        self.speed_samples.append((now, update_bytes))
+        while now - self.speed_samples[0][0] > SPEED_WINDOW:
+            self.speed_samples.popleft()
+        if self.last_sample is None:
+            self.last_sample = (now, update_bytes)
+        elif now - self.last_sample[0] >= 1.0:
+            metrics.sample_throughput((update_bytes - self.last_sample[1]) / (now - self.last_sample[0]))
+            self.last_sample = (now, update_bytes)
+
+progress = ProgressRenderer()
+
+def status(msg=' '):
+    progress.message = msg
+
+def write_metrics(success):
+    """ Writes the metrics of this run as JSON next to the snapshot, and as a Prometheus textfile. """
+    now = time.time()
+    with metrics.lock:
+        phases = metrics.phases.copy()
+        if metrics.phase:
+            phases[metrics.phase] = phases.get(metrics.phase, 0.0) + now - metrics.phase_started
+        latency = dict((endpoint, list(counts)) for endpoint, counts in metrics.latency.iteritems())
+        latency_sum = dict(metrics.latency_sum)
+        outcomes = dict(metrics.outcomes)
+        throughput = list(metrics.throughput)
+    report = collections.OrderedDict()
+    report['success'] = success
+    report['started'] = metrics.started
+    report['finished'] = now
+    report['duration'] = now - metrics.started
+    report['phases'] = phases
+    deferred_count, deferred_bytes = 0, 0
+    if space_budget:
+        deferred_count, deferred_bytes = len(space_budget.deferred), space_budget.deferred_bytes
+    report['items'] = {'listed': total_count, 'updated': update_count, 'linked': link_count, 'deferred': deferred_count, 'errors': error_count}
+    report['bytes'] = {'listed': listed_bytes, 'job': job_size, 'downloaded': update_bytes, 'linked': link_bytes, 'deferred': deferred_bytes}
+    report['throughput'] = {
+        'mean': sum(throughput) / len(throughput) if throughput else 0.0,
+        'p50': metrics.percentile(0.5),
+        'p90': metrics.percentile(0.9),
+        'p99': metrics.percentile(0.99),
+        'max': max(throughput or [0.0]),
+    }
+    endpoints = {}
+    for endpoint, counts in latency.iteritems():
+        endpoints[endpoint] = {
+            'buckets': collections.OrderedDict(zip([str(le) for le in API_LATENCY_BUCKETS] + ['+Inf'], counts)),
+            'count': sum(counts),
+            'sum': latency_sum[endpoint],
+            'outcomes': dict((outcome, n) for (name, outcome), n in outcomes.iteritems() if name == endpoint),
+        }
+    report['api'] = {
+        'calls': rate_limiter.calls,
+        'retries': rate_limiter.retries,
+        'rate_limited': rate_limiter.rate_limited,
+        'throttled': rate_limiter.throttled,
+        'endpoints': endpoints,
+    }
+    if metrics.json_path:
+        open(metrics.json_path, 'w').write(json.dumps(report, indent=4))
+    if metrics.prom_path:
+        lines = []
+        def metric(name, kind, help, samples, suffix=''):
+            lines.append('# HELP dropbox_snapshot_%s %s' % (name, help))
+            lines.append('# TYPE dropbox_snapshot_%s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % label for label in labels)
+                lines.append('dropbox_snapshot_%s%s%s %r' % (name, suffix, '{%s}' % label_text if label_text else '', float(value)))
+        metric('last_run_success', 'gauge', 'Whether the last run completed.', [((), int(success))])
+        metric('last_run_timestamp_seconds', 'gauge', 'When the last run ended.', [((), now)])
+        metric('last_run_duration_seconds', 'gauge', 'Duration of the last run.', [((), report['duration'])])
+        metric('phase_duration_seconds', 'gauge', 'Duration of each phase of the last run.',
+            [((('phase', phase),), seconds) for phase, seconds in phases.iteritems()])
+        metric('items', 'gauge', 'Files and folders listed, updated, linked, deferred and failed in the last run.',
+            [((('kind', kind),), n) for kind, n in sorted(report['items'].iteritems())])
+        metric('bytes', 'gauge', 'Bytes listed, planned, downloaded, linked and deferred in the last run.',
+            [((('kind', kind),), n) for kind, n in sorted(report['bytes'].iteritems())])
+        metric('download_throughput_bytes_per_second', 'gauge', 'Download throughput of the last run, sampled every second.',
+            [((('quantile', q),), report['throughput'][key]) for q, key in [('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99')]])
+        metric('api_calls', 'gauge', 'API calls, retries and rate limited calls in the last run.',
+            [((('kind', kind),), report['api'][kind]) for kind in ['calls', 'retries', 'rate_limited']])
+        metric('api_throttled_seconds', 'gauge', 'Time spent waiting on the rate limiter in the last run.', [((), rate_limiter.throttled)])
+        samples = []
+        for endpoint in sorted(latency):
+            cumulative = 0
+            for le, n in zip([str(le) for le in API_LATENCY_BUCKETS] + ['+Inf'], latency[endpoint]):
+                cumulative += n
+                samples.append(((('endpoint', endpoint), ('le', le)), cumulative))
+        metric('api_latency_seconds', 'histogram', 'API call latency per endpoint in the last run.', samples, '_bucket')
+        for endpoint in sorted(latency):
+            lines.append('dropbox_snapshot_api_latency_seconds_sum{endpoint="%s"} %r' % (endpoint, latency_sum[endpoint]))
+            lines.append('dropbox_snapshot_api_latency_seconds_count{endpoint="%s"} %r' % (endpoint, float(sum(latency[endpoint]))))
+        metric('api_outcomes', 'gauge', 'API call attempts per endpoint and outcome in the last run.',
+            [((('endpoint', endpoint), ('outcome', outcome)), n) for (endpoint, outcome), n in sorted(outcomes.iteritems())])
+        # Written aside and renamed, the textfile collector must never read a partial file
+        open(metrics.prom_path + '.tmp', 'w').write('\n'.join(lines) + '\n')
+        os.rename(metrics.prom_path + '.tmp', metrics.prom_path)
+
+def log_error(remote_path, message):
+    global error_log_path, error_count
+    with error_log_lock:
+        open(error_log_path, 'a').write(remote_path.encode('utf8') + ': ' + message +'\n')
+        error_count += 1
+
+def http_session():
+    """ Returns a requests session for the calling thread. """
+    if not hasattr(http_local, 'session'):
+        http_local.session = requests.Session()
+    return http_local.session
+
+def raise_for_status(response):
+    """ Raises the exception the Dropbox SDK would raise for a failed request. """
+    request_id = response.headers.get('X-Dropbox-Request-Id')
+    if response.status_code in [200, 206]:
+        return
+    if response.status_code == 429:
+        raise dropbox.exceptions.RateLimitError(request_id, backoff=float(response.headers.get('Retry-After', 1)))
+    if response.status_code >= 500:
+        raise dropbox.exceptions.InternalServerError(request_id, response.status_code, response.text)
+    if response.status_code == 409:
+        try:
+            error = response.json().get('error_summary')
+        except ValueError:
+            error = response.text
+        raise dropbox.exceptions.ApiError(request_id, error, None, None)
+    raise dropbox.exceptions.HttpError(request_id, response.status_code, response.text)
+
+def open_range(remote_path, rev, offset, restart):
+    """ Requests a file from offset on. Returns its metadata and a generator of its content. """
+    start = max(offset-1, 0) # One byte is fetched again, so a complete file still gets a response
+    arg = {'path': 'rev:'+rev if rev else remote_path}
+    headers = {
+        'Authorization': 'Bearer ' + access_token,
+        'Dropbox-API-Arg': json.dumps(arg),
+        'Range': 'bytes=%i-' % start,
+    }
+    url = 'https://%s/2/files/download' % dropbox.session.API_CONTENT_HOST
+    response = http_session().post(url, headers=headers, stream=True, timeout=60)
+    try:
+        if response.status_code == 416: # The file is shorter than what was written so far
+            restart()
+            raise requests.exceptions.ConnectionError('Range not satisfiable, restarting %s' % remote_path.encode('utf8'))
+        raise_for_status(response)
+        metadata = json.loads(response.headers['Dropbox-API-Result'])
+    except:
+        response.close()
+        raise
+    if response.status_code == 200: # The range was ignored
+        restart()
+        offset = start = 0
+    return metadata, range_chunks(response, offset - start, offset, metadata['size'])
+
+def range_chunks(response, skip, received, size):
+    try:
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            if skip:
+                chunk, skip = chunk[skip:], skip - len(chunk[:skip])
+            if chunk:
+                received += len(chunk)
+                yield chunk
+        if received < size:
+            raise requests.exceptions.ConnectionError('Connection closed at offset %i' % received)
+    except requests.exceptions.ChunkedEncodingError as e:
+        raise requests.exceptions.ConnectionError(str(e)) # Retried by api_call, from what was written
+    finally:
+        response.close()
+
+class RangedDownload:
+    """ Streams a file into a fsynced .part file with HTTP Range requests. """
+    def __init__(self, local_file_path, remote_path, rev=None):
+        self.local_file_path = local_file_path
+        self.part_path = local_file_path + u'.part'
+        self.remote_path = remote_path
+        self.rev = rev
+
+    def __call__(self):
+        self.hasher = ContentHasher()
+        offset = 0
+        if os.path.isfile(self.part_path):
+            with open(self.part_path, 'rb') as part:
+                while True:
+                    block = part.read(DOWNLOAD_CHUNK_SIZE)
+                    if not block:
+                        break
+                    self.hasher.update(block)
+                    offset += len(block)
+        metadata, chunks = open_range(self.remote_path, self.rev, offset, self.restart)
+        self.rev = metadata['rev']
+        with open(self.part_path, 'r+b' if os.path.isfile(self.part_path) else 'wb') as part:
+            part.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                part.write(chunk)
+                self.hasher.update(chunk)
+                part.flush()
+                os.fsync(part.fileno())
+        if self.hasher.hexdigest() != metadata['content_hash']:
+            os.remove(self.part_path)
+            raise IOError('content_hash mismatch for rev %s, discarded the partial download' % self.rev)
+        os.rename(self.part_path, self.local_file_path)
+        return metadata
+
+    def restart(self):
+        self.hasher = ContentHasher()
+        if os.path.isfile(self.part_path):
+            os.remove(self.part_path)
+
+def files_download_to_file(dbx, download_path, remote_path, rev=None):
+    """ dbx.files_download_to_file, failing like a dropped connection when the body was cut short. """
+    metadata = dbx.files_download_to_file(download_path, remote_path, rev)
+    if os.path.getsize(download_path) != metadata.size:
+        raise requests.exceptions.ConnectionError('Received %i of %i bytes' % (os.path.getsize(download_path), metadata.size))
+    return metadata
+
+class BlockDownload:
+    """ Streams a file into a ChunkStore with HTTP Range requests. """
+    def __init__(self, store, remote_path, rev=None):
+        self.store = store
+        self.remote_path = remote_path
+        self.rev = rev
+        self.digests = []
+
+    def __call__(self):
+        metadata, chunks = open_range(self.remote_path, self.rev, len(self.digests) * HASH_BLOCK_SIZE, self.restart)
+        self.rev = metadata['rev']
+        block = []
+        block_size = 0
+        for chunk in chunks:
+            while chunk:
+                piece = chunk[:HASH_BLOCK_SIZE-block_size]
+                chunk = chunk[len(piece):]
+                block.append(piece)
+                block_size += len(piece)
+                if block_size == HASH_BLOCK_SIZE:
+                    self.put(''.join(block))
+                    block = []
+                    block_size = 0
+        if block_size:
+            self.put(''.join(block))
+        if ChunkStore.content_hash(self.digests) != metadata['content_hash']:
+            self.digests = []
+            raise IOError('content_hash mismatch for rev %s' % self.rev)
+        return metadata, self.digests
+
+    def restart(self):
+        self.digests = []
+
+    def put(self, block):
+        digest = hashlib.sha256(block).hexdigest()
+        self.store.put(digest, block)
+        self.digests.append(digest)
+
+def discard_part(local_file_path, size):
+    """ Cleans up after a failed download, keeping a ranged .part for -j. """
+    if local_file_path is None:
         return
+    part_path = local_file_path + u'.part'
+    if size >= CHUNKED_DOWNLOAD_SIZE:
+        with stats_lock:
+            failed_parts.append(part_path)
+    elif os.path.isfile(part_path):
+        os.remove(part_path)
+
+def download_file(dbx, local_file_path, remote_path, size, job_id=None, rev=None):
+    """ Downloads a file to local_file_path, or into chunk_store if it is None. """
+    global update_count, total_count, update_bytes, queue_bytes
+    #clear_line()
     status(remote_path.encode('utf8'))
+    if space_budget and not space_budget.acquire(size):
+        space_budget.defer(job_id, remote_path, size)
+        with stats_lock:
+            queue_bytes -= size
+        return
     try:
-        api_call(dbx.files_download_to_file, local_file_path, remote_path)
-        update_count += 1
-        update_bytes += size
-        queue_bytes -= size
+        blocks = None
+        if local_file_path is None:
+            metadata, blocks = api_call(BlockDownload(chunk_store, remote_path, rev))
+        else:
+            if size >= CHUNKED_DOWNLOAD_SIZE:
+                metadata = api_call(RangedDownload(local_file_path, remote_path, rev))
+                client_modified = datetime.datetime.strptime(metadata['client_modified'], '%Y-%m-%dT%H:%M:%SZ')
+                file_hash = metadata['content_hash']
+            else:
+                # Written next to the file and renamed, so an interrupted download never looks complete
+                metadata = api_call(files_download_to_file, dbx, local_file_path + u'.part', remote_path, rev)
+                os.rename(local_file_path + u'.part', local_file_path)
+                client_modified = metadata.client_modified
+                file_hash = metadata.content_hash
+            set_mtime(local_file_path, client_modified)
+            if hash_cache:
+                hash_cache.put(os.stat(local_file_path), file_hash)
+        if job_id is not None:
+            journal.done(job_id, blocks)
+        with stats_lock:
+            update_count += 1
+            update_bytes += size
+            queue_bytes -= size
     except dropbox.exceptions.ApiError as e:
-        queue_bytes -= size
-        open(error_log_path, 'a').write(remote_path.encode('utf8') + ': ' + str(e) +'\n')
-        error_count += 1  
+        with stats_lock:
+            queue_bytes -= size
+        discard_part(local_file_path, size)
+        log_error(remote_path, str(e))
     except requests.exceptions.ReadTimeout as e:
-        queue_bytes -= size
-        open(error_log_path, 'a').write(remote_path.encode('utf8') + ': ' + str(e)+'\n')  
-        error_count += 1  
+        with stats_lock:
+            queue_bytes -= size
+        discard_part(local_file_path, size)
+        log_error(remote_path, str(e))
     except requests.exceptions.ConnectionError as e:
-        queue_bytes -= size
-        open(error_log_path, 'a').write(remote_path.encode('utf8') + ': ' + str(e)+'\n')  
-        error_count += 1        
-    except IOError as e:
-        if e.errno == errno.ENOSPC:
+        with stats_lock:
+            queue_bytes -= size
+        discard_part(local_file_path, size)
+        log_error(remote_path, str(e))
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOSPC and not space_budget:
             raise
-        queue_bytes -= size
-        open(error_log_path, 'a').write(remote_path.encode('utf8') + ': ' + str(e)+'\n')  
-        error_count += 1        
+        with stats_lock:
+            queue_bytes -= size
+        if e.errno == errno.ENOSPC:
+            # Something else filled the disk, the file is left for the next run
+            if local_file_path and os.path.isfile(local_file_path + u'.part'):
+                os.remove(local_file_path + u'.part')
+            space_budget.defer(job_id, remote_path, size)
+        else:
+            discard_part(local_file_path, size)
+            log_error(remote_path, str(e))
     except:
-        line = 'Unknown, fatal error ' + remote_path.encode('utf8') + '\n'
-        open(error_log_path, 'a').write(line)
-        error_count += 1  
-        print line
-        queue_bytes -= size
+        log_error(remote_path, 'Unknown, fatal error')
+        print 'Unknown, fatal error ' + remote_path.encode('utf8')
+        with stats_lock:
+            queue_bytes -= size
         raise
+    finally:
+        if space_budget:
+            space_budget.release(size)
+
+class SpaceBudget:
+    """ Defers the downloads that would leave less than the reserve free on the backup disk. """
+    def __init__(self, path, reserve):
+        self.path = path
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.deferred = {} # job id -> remote path
+        self.deferred_bytes = 0
+
+    def fits(self, size):
+        return disk_free(self.path) - self.in_flight - size >= self.reserve
 
+    def acquire(self, size):
+        with self.lock:
+            if not self.fits(size):
+                return False
+            self.in_flight += size
+            return True
 
+    def release(self, size):
+        with self.lock:
+            self.in_flight -= size
+
+    def defer(self, job_id, remote_path, size):
+        logging.warning( 'Not enough space, deferred to the next run: ' + remote_path.encode('utf8') )
+        with self.lock:
+            self.deferred[job_id] = remote_path
+            self.deferred_bytes += size
+
+    def write(self, deferred_path, job_path):
+        """ Writes the journal entries of the deferred files, one JSON object per line. """
+        with open(deferred_path, 'w') as f:
+            for record in JobJournal.read(job_path):
+                if record.get('id') in self.deferred and 'op' in record:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+def read_deferred(snapshot):
+    """ Returns the journal entries deferred by the run that made snapshot. """
+    entries = []
+    if not snapshot or not os.path.isfile(snapshot+'.deferred'):
+        return entries
+    for line in open(snapshot+'.deferred'):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            pass
+    return entries
+
+def make_room(needed, path, reserve, snapshots, fs):
+    """ Removes snapshots, oldest first, until needed bytes fit above the reserve. """
+    for snapshot in snapshots:
+        if disk_free(path) - needed >= reserve:
+            break
+        logging.warning( 'Removing old snapshot early to make room: ' + snapshot.encode('utf8') )
+        print 'Removing %s early to make room' % snapshot
+        fs.remove(snapshot)
+        snapshot_name = snapshot.replace('.incomplete', '').replace('.temp', '')
+        for ext in SNAPSHOT_FILES:
+            if os.path.isfile(snapshot_name+ext):
+                os.remove(snapshot_name+ext)
+    return disk_free(path) - needed >= reserve
+
+class ChunkStore:
+    """ Content-addressed, reference counted store of compressed 4 MiB file blocks. """
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.connection = sqlite3.connect(os.path.join(folder, 'refs.db'))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS refs (block TEXT PRIMARY KEY, count INTEGER) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS manifests (name TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.lock = threading.Lock()
+        self.added = 0
+        self.added_bytes = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    def block_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def put_file(self, local_file_path):
+        """ Stores the blocks of a file that are not stored yet. Returns the digests of all its blocks, in order. """
+        digests = []
+        with open(local_file_path, 'rb') as f:
+            while True:
+                block = f.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                digest = hashlib.sha256(block).hexdigest()
+                self.put(digest, block)
+                digests.append(digest)
+        return digests
+
+    def put(self, digest, block):
+        block_path = self.block_path(digest)
+        if os.path.isfile(block_path):
+            return
+        compressed = zlib.compress(block)
+        if len(compressed) < len(block):
+            data = 'z' + compressed
+        else:
+            data = 'r' + block
+        try:
+            os.makedirs(os.path.dirname(block_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Download workers may store the same block at once, each one writes its own temporary file
+        temp_path = '%s.%i.temp' % (block_path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, block_path)
+        with self.lock:
+            self.added += 1
+            self.added_bytes += len(data)
+
+    def get(self, digest):
+        """ Returns the data of a block, checked against its digest. """
+        block = ChunkStore.read(self.block_path(digest))
+        if hashlib.sha256(block).hexdigest() != digest:
+            raise IOError('Corrupt block: ' + self.block_path(digest))
+        return block
+
+    @staticmethod
+    def read(block_path):
+        """ Returns the data of a block file, unchecked. """
+        data = open(block_path, 'rb').read()
+        if data[:1] == 'z':
+            return zlib.decompress(data[1:])
+        return data[1:]
+
+    @staticmethod
+    def content_hash(digests):
+        """ Returns the content_hash of a file from the digests of its blocks. """
+        return hashlib.sha256(''.join(digest.decode('hex') for digest in digests)).hexdigest()
+
+    def is_retained(self, name):
+        return self.connection.execute('SELECT 1 FROM manifests WHERE name = ?', (name,)).fetchone() is not None
+
+    def retain(self, manifest_path, name):
+        """ Adds a reference to every block of a manifest, once per snapshot name. """
+        if self.is_retained(name):
+            return
+        self.connection.execute('ATTACH DATABASE ? AS manifest', (manifest_path,))
+        try:
+            self.connection.execute('INSERT OR IGNORE INTO refs SELECT DISTINCT block, 0 FROM manifest.blocks')
+            self.connection.execute('UPDATE refs SET count = count + 1 WHERE block IN (SELECT block FROM manifest.blocks)')
+            self.connection.execute('INSERT INTO manifests VALUES (?)', (name,))
+            self.connection.commit()
+        finally:
+            self.connection.rollback() # A database cannot be detached in a transaction
+            self.connection.execute('DETACH DATABASE manifest')
+
+    def release(self, manifest_path, name):
+        """ Drops the references of a manifest, and removes the blocks that no other manifest uses. """
+        if not self.is_retained(name):
+            return
+        if not os.path.isfile(manifest_path):
+            logging.warning( 'Manifest is missing, its blocks are kept: ' + manifest_path )
+            self.connection.execute('DELETE FROM manifests WHERE name = ?', (name,))
+            self.connection.commit()
+            return
+        self.connection.execute('ATTACH DATABASE ? AS manifest', (manifest_path,))
+        try:
+            self.connection.execute('UPDATE refs SET count = count - 1 WHERE block IN (SELECT block FROM manifest.blocks)')
+            unused = [row[0] for row in self.connection.execute('SELECT block FROM refs WHERE count <= 0')]
+            self.connection.execute('DELETE FROM refs WHERE count <= 0')
+            self.connection.execute('DELETE FROM manifests WHERE name = ?', (name,))
+            self.connection.commit()
+        finally:
+            self.connection.rollback()
+            self.connection.execute('DETACH DATABASE manifest')
+        # Blocks are removed once the counts are committed, an interruption leaves unused blocks rather than missing ones
+        for digest in unused:
+            block_path = self.block_path(digest)
+            try:
+                size = os.path.getsize(block_path)
+                os.remove(block_path)
+            except OSError:
+                continue
+            self.removed += 1
+            self.removed_bytes += size
+
+    def sweep(self, keep=()):
+        """ Removes the blocks that no manifest uses, but those in keep, and temporary files. """
+        for prefix in os.listdir(self.folder):
+            folder = os.path.join(self.folder, prefix)
+            if len(prefix) != 2 or not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if name in keep:
+                    continue
+                if not name.endswith('.temp') and self.connection.execute('SELECT 1 FROM refs WHERE block = ?', (name,)).fetchone():
+                    continue
+                block_path = os.path.join(folder, name)
+                try:
+                    size = os.path.getsize(block_path)
+                    os.remove(block_path)
+                except OSError:
+                    continue
+                self.removed += 1
+                self.removed_bytes += size
+
+    def summary(self):
+        return 'Blocks stored: %i new (%s), %i removed (%s)' % (self.added, human_size(self.added_bytes), self.removed, human_size(self.removed_bytes))
+
+    def close(self):
+        self.connection.close()
+
+class Manifest:
+    """ Sorted, indexed list of the files in a snapshot, kept in <snapshot>.manifest. """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+
+    @staticmethod
+    def path_of(snapshot):
+        return snapshot.replace('.incomplete', '') + '.manifest'
+
+    @staticmethod
+    def open(snapshot):
+        """ Returns the manifest of a snapshot, or None if it has none. """
+        path = Manifest.path_of(snapshot)
+        if not os.path.isfile(path):
+            return None
+        return Manifest(path)
+
+    def get(self, path):
+        """ Returns (path, size, client_modified, rev, content_hash, inode) for a remote path, or None. """
+        return self.connection.execute('SELECT path, size, client_modified, rev, content_hash, inode FROM files WHERE path_lower = ?', (path.lower(),)).fetchone()
+
+    def find(self, content_hash):
+        """ Yields the paths of the files whose content_hash starts with the given hex digits. """
+        prefix = content_hash.lower()
+        for row in self.connection.execute('SELECT path FROM files WHERE content_hash >= ? AND content_hash < ? ORDER BY path_lower', (prefix, prefix + 'g')):
+            yield row[0]
+
+    def diff(self, other):
+        """ Yields (op, path) for the files added, removed and changed from this snapshot to other. """
+        self.connection.execute('ATTACH DATABASE ? AS other', (other.path,))
+        try:
+            query = '''
+                SELECT '-', a.path, a.path_lower FROM files a LEFT JOIN other.files b ON a.path_lower = b.path_lower WHERE b.path_lower IS NULL
+                UNION ALL
+                SELECT '+', b.path, b.path_lower FROM other.files b LEFT JOIN files a ON a.path_lower = b.path_lower WHERE a.path_lower IS NULL
+                UNION ALL
+                SELECT 'u', b.path, b.path_lower FROM files a JOIN other.files b ON a.path_lower = b.path_lower
+                    WHERE (a.inode IS NULL OR b.inode IS NULL OR a.inode != b.inode) AND (a.content_hash IS NOT b.content_hash OR a.size != b.size)
+                ORDER BY 3'''
+            for op, path, path_lower in self.connection.execute(query):
+                yield op, path
+        finally:
+            self.connection.execute('DETACH DATABASE other')
+
+    def close(self):
+        self.connection.close()
+
+    def files(self):
+        """ Yields (path, size, rev, content_hash) for every file, in path order. """
+        return self.connection.execute('SELECT path, size, rev, content_hash FROM files ORDER BY path_lower')
+
+    def distinct_blocks(self):
+        for row in self.connection.execute('SELECT DISTINCT block FROM blocks'):
+            yield row[0]
+
+    def files_using(self, block):
+        """ Returns the paths of the files made of a block. """
+        query = 'SELECT DISTINCT f.path FROM blocks b JOIN files f ON f.path_lower = b.path_lower WHERE b.block = ?'
+        return [row[0] for row in self.connection.execute(query, (block,))]
+
+    def has_blocks(self):
+        """ Returns whether the snapshot was made by the chunks backend. """
+        return self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'blocks'").fetchone() is not None
+
+    def has_folder(self, path):
+        """ Returns whether any file is under a remote folder. """
+        folder = path.lower().rstrip(u'/') + u'/'
+        return self.connection.execute('SELECT 1 FROM files WHERE path_lower >= ? AND path_lower < ? LIMIT 1', (folder, folder[:-1] + u'0')).fetchone() is not None
+
+    def blocks_of(self, content_hash):
+        """ Returns the block digests of a file with this content_hash, or None if there is none. """
+        if not content_hash or not self.has_blocks():
+            return None
+        row = self.connection.execute('SELECT path_lower FROM files WHERE content_hash = ? LIMIT 1', (content_hash,)).fetchone()
+        if row is None:
+            return None
+        return [block for block, in self.connection.execute('SELECT block FROM blocks WHERE path_lower = ? ORDER BY n', row)]
+
+    def chunked_files(self):
+        """ Yields (path, client_modified, block digests) for every file, in path order. """
+        query = 'SELECT f.path, f.client_modified, b.block FROM files f LEFT JOIN blocks b ON f.path_lower = b.path_lower ORDER BY f.path_lower, b.n'
+        current = None
+        for path, client_modified, block in self.connection.execute(query):
+            if current is None or current[0] != path:
+                if current:
+                    yield current
+                current = (path, client_modified, [])
+            if block:
+                current[2].append(block)
+        if current:
+            yield current
+
+    @staticmethod
+    def write(snapshot_now, snapshot_incomplete, snapshot_previous, job_path, store=None):
+        """ Writes the manifest of a finished snapshot from the previous manifest and the journal. """
+        path = Manifest.path_of(snapshot_now)
+        name = os.path.basename(snapshot_now)
+        temp_path = path + '.temp'
+        if os.path.isfile(temp_path):
+            if store:
+                store.release(temp_path, name) # Retained by an interrupted run
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        connection.execute('CREATE TABLE files (path_lower TEXT PRIMARY KEY, path TEXT, size INTEGER, client_modified TEXT, rev TEXT, content_hash TEXT, inode INTEGER) WITHOUT ROWID')
+        if store:
+            connection.execute('CREATE TABLE blocks (path_lower TEXT, n INTEGER, block TEXT, PRIMARY KEY (path_lower, n)) WITHOUT ROWID')
+        root = unicode_path(snapshot_incomplete) if snapshot_incomplete else None
+        def remove(path):
+            for table in ['files', 'blocks'] if store else ['files']:
+                if path.endswith(u'/'):
+                    connection.execute('DELETE FROM %s WHERE path_lower >= ? AND path_lower < ?' % table, (path.lower(), path.lower()[:-1] + u'0'))
+                else:
+                    connection.execute('DELETE FROM %s WHERE path_lower = ?' % table, (path.lower(),))
+        def changed(path_lower, size, file_hash, inode):
+            # Inodes of removed files are reused, so a known content_hash is compared as well
+            row = connection.execute('SELECT inode, size, content_hash FROM files WHERE path_lower = ?', (path_lower,)).fetchone()
+            return row is None or row[:2] != (inode, size) or (file_hash and row[2] != file_hash)
+        def update(remote_path, size, client_modified, rev, file_hash, inode):
+            path_lower = remote_path.lower()
+            if store and changed(path_lower, size, file_hash, inode):
+                digests = store.put_file(root + remote_path)
+                connection.execute('DELETE FROM blocks WHERE path_lower = ?', (path_lower,))
+                connection.executemany('INSERT INTO blocks VALUES (?, ?, ?)', [(path_lower, n, digest) for n, digest in enumerate(digests)])
+                file_hash = file_hash or ChunkStore.content_hash(digests)
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', (path_lower, remote_path,
+                size, client_modified, rev, file_hash, inode))
+        previous = snapshot_previous and Manifest.path_of(snapshot_previous)
+        if previous and os.path.isfile(previous):
+            connection.execute('ATTACH DATABASE ? AS previous', (previous,))
+            previous_blocks = connection.execute("SELECT 1 FROM previous.sqlite_master WHERE type = 'table' AND name = 'blocks'").fetchone()
+            if not store:
+                connection.execute('INSERT INTO files SELECT * FROM previous.files')
+            elif previous_blocks:
+                connection.execute('INSERT INTO files SELECT * FROM previous.files')
+                connection.execute('INSERT INTO blocks SELECT * FROM previous.blocks')
+            connection.commit()
+            connection.execute('DETACH DATABASE previous')
+        elif not store:
+            connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, NULL, NULL, ?, ?)', Manifest.walk(root))
+        if root is None:
+            connection.execute('CREATE TEMP TABLE seen (path_lower TEXT PRIMARY KEY) WITHOUT ROWID')
+            connection.execute('CREATE TEMP TABLE done (id INTEGER PRIMARY KEY, blocks TEXT)')
+            for record in JobJournal.read(job_path):
+                if 'blocks' in record:
+                    connection.execute('INSERT OR REPLACE INTO done VALUES (?, ?)', (record['done'], json.dumps(record['blocks'])))
+            scanned = []
+            for record in JobJournal.read(job_path):
+                if 'scan' in record:
+                    scanned.append(record['scan'].rstrip(u'/').lower() + u'/')
+                if not 'op' in record:
+                    continue
+                if record['op'] == '-':
+                    remove(record['path'])
+                    continue
+                path_lower = record['path'].lower()
+                connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (path_lower,))
+                if record['op'] == ' ':
+                    continue
+                row = connection.execute('SELECT blocks FROM done WHERE id = ?', (record['id'],)).fetchone()
+                if row is None: # Not downloaded
+                    remove(record['path'])
+                    continue
+                connection.execute('DELETE FROM blocks WHERE path_lower = ?', (path_lower,))
+                connection.executemany('INSERT INTO blocks VALUES (?, ?, ?)', [(path_lower, n, digest) for n, digest in enumerate(json.loads(row[0]))])
+                connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, NULL)', (path_lower, record['path'],
+                    record['size'], record['mtime'], record['rev'], record['hash']))
+            for folder in scanned:
+                for table in ['files', 'blocks']:
+                    connection.execute('DELETE FROM %s WHERE path_lower >= ? AND path_lower < ? AND path_lower NOT IN (SELECT path_lower FROM seen)' % table,
+                        (folder, folder[:-1] + u'0'))
+        else:
+            for record in JobJournal.read(job_path):
+                if 'scan' in record and not store:
+                    remove(record['scan'].rstrip(u'/') + u'/')
+                if not 'op' in record or record['path'].endswith(u'/'):
+                    if record.get('op') == '-':
+                        remove(record['path'])
+                    continue
+                remote_path = record['path']
+                try:
+                    st = os.lstat(root + remote_path)
+                except OSError:
+                    st = None
+                if record['op'] == '-' or st is None or not stat.S_ISREG(st.st_mode):
+                    remove(remote_path)
+                    continue
+                update(remote_path, record['size'], record['mtime'], record['rev'], record['hash'], st.st_ino)
+            if store:
+                connection.execute('CREATE TEMP TABLE seen (path_lower TEXT PRIMARY KEY) WITHOUT ROWID')
+                for path_lower, remote_path, size, file_hash, inode in Manifest.walk(root):
+                    connection.execute('INSERT OR IGNORE INTO seen VALUES (?)', (path_lower,))
+                    if changed(path_lower, size, file_hash, inode):
+                        update(remote_path, size, None, None, file_hash, inode)
+                connection.execute('DELETE FROM files WHERE path_lower NOT IN (SELECT path_lower FROM seen)')
+                connection.execute('DELETE FROM blocks WHERE path_lower NOT IN (SELECT path_lower FROM seen)')
+        connection.execute('CREATE INDEX content_hash ON files (content_hash)')
+        connection.commit()
+        connection.close()
+        if store:
+            store.retain(temp_path, name)
+        os.rename(temp_path, path)
+
+    @staticmethod
+    def walk(root):
+        """ Yields a manifest row for every file under root, with the content_hash if it is cached. """
+        folders = [root]
+        while folders:
+            folder = folders.pop()
+            for entry in scandir(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISREG(st.st_mode):
+                    remote_path = entry.path[len(root):]
+                    yield remote_path.lower(), remote_path, st.st_size, hash_cache.lookup(st), st.st_ino
+
+def snapshot_manifests(folder):
+    """ Returns (name, Manifest) for every snapshot in folder that has a manifest, oldest first. """
+    manifests = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.manifest'):
+            manifests.append((name[:-len('.manifest')], Manifest(os.path.join(folder, name))))
+    return manifests
+
+def find_manifest(folder, snapshot):
+    """ Returns the Manifest of a snapshot given by name or path. """
+    for path in [snapshot, os.path.join(folder, snapshot)]:
+        manifest = Manifest.open(path.rstrip('/'))
+        if manifest:
+            return manifest
+    logging.error( 'No manifest for snapshot: ' + snapshot )
+    sys.exit(1)
+
+def query_manifests(config, args):
+    """ Answers --diff, --history and --find from the snapshot manifests. """
+    if args.diff:
+        old, new = find_manifest(config.folder, args.diff[0]), find_manifest(config.folder, args.diff[1])
+        counts = collections.defaultdict(int)
+        for op, path in old.diff(new):
+            counts[op] += 1
+            print '%s %s' % (op, path.encode('utf8'))
+        print '%i added, %i removed, %i changed' % (counts['+'], counts['-'], counts['u'])
+    if args.history:
+        remote_path = u'/' + args.history.decode('utf8').strip(u'/')
+        versions = [] # [first snapshot, last snapshot, row]
+        previous_name = None
+        for name, manifest in snapshot_manifests(config.folder):
+            row = manifest.get(remote_path)
+            # Hardlinked versions share an inode, those without one share a content_hash
+            if row and versions and versions[-1][1] == previous_name and (versions[-1][2][5], versions[-1][2][4]) == (row[5], row[4]):
+                versions[-1][1] = name
+            elif row:
+                versions.append([name, name, row])
+            previous_name = name
+        for first, last, (path, size, client_modified, rev, file_hash, inode) in versions:
+            print '%s .. %s  %s  %s  rev %s  %s' % (first, last, human_size(size).rjust(10), client_modified or '-', rev or '-', file_hash or '-')
+        if not versions:
+            print 'Not in any snapshot: ' + remote_path.encode('utf8')
+    if args.find:
+        wanted = args.find
+        if os.path.isfile(args.find):
+            wanted = content_hash(args.find)
+        found = 0
+        for name, manifest in snapshot_manifests(config.folder):
+            for path in manifest.find(wanted):
+                found += 1
+                print '%s  %s' % (name, path.encode('utf8'))
+        print '%i found' % found
+
+def chunk_snapshots(folder, rotations, mirror=None):
+    """ Returns the previous, retained and expired snapshots of the chunks backend. """
+    names = sorted(set(name[:-len('.job')] for name in os.listdir(folder) if name.endswith('.job')), reverse=True)
+    names = [name for name in names if not os.path.isdir(os.path.join(folder, name)) and not os.path.isdir(os.path.join(folder, name+'.incomplete'))]
+    previous = False
+    if not mirror or os.path.isdir(mirror):
+        for name in names:
+            if os.path.isfile(os.path.join(folder, name+'.manifest')):
+                previous = os.path.join(folder, name)
+                break
+    retained = [os.path.join(folder, name) for name in names[:rotations] if os.path.isfile(os.path.join(folder, name+'.manifest'))]
+    expired = [os.path.join(folder, name) for name in names[rotations:]]
+    return previous, [snapshot for snapshot in retained if snapshot != previous], [snapshot for snapshot in expired if snapshot != previous]
+
+def unfinished_blocks(folder):
+    """ Returns the blocks listed by the journals of unfinished chunks snapshots. """
+    blocks = set()
+    for name in os.listdir(folder):
+        snapshot = os.path.join(folder, name[:-len('.job')])
+        if name.endswith('.job') and not os.path.isdir(snapshot) and not os.path.isfile(Manifest.path_of(snapshot)):
+            for record in JobJournal.read(os.path.join(folder, name)):
+                blocks.update(record.get('blocks', []))
+    return blocks
+
+def write_blocks(store, digests, local_file_path):
+    """ Writes a file from its blocks, through a .part file. Returns its size. """
+    size = 0
+    with open(local_file_path + u'.part', 'wb') as f:
+        for digest in digests:
+            block = store.get(digest)
+            f.write(block)
+            size += len(block)
+    os.rename(local_file_path + u'.part', local_file_path)
+    return size
+
+def restore_snapshot(config, snapshot, target):
+    """ Writes the files of a snapshot of the chunks backend to target. """
+    manifest = find_manifest(config.folder, snapshot)
+    if not manifest.has_blocks():
+        logging.error( 'Not a snapshot of the chunks backend, its files can be copied as they are: ' + snapshot )
+        sys.exit(1)
+    store = ChunkStore(os.path.join(config.folder, CHUNKS_FOLDER))
+    target = unicode_path(os.path.abspath(target))
+    count = 0
+    size = 0
+    for path, client_modified, digests in manifest.chunked_files():
+        local_file_path = target + path
+        logging.info( 'Restoring ' + path.encode('utf8') )
+        if not os.path.isdir(os.path.dirname(local_file_path)):
+            os.makedirs(os.path.dirname(local_file_path))
+        size += write_blocks(store, digests, local_file_path)
+        if client_modified:
+            set_mtime(local_file_path, datetime.datetime.strptime(client_modified, '%Y-%m-%dT%H:%M:%SZ'))
+        count += 1
+    print 'Restored %i files (%s) to %s' % (count, human_size(size), target.encode('utf8'))
+    store.close()
+
+def verify_snapshot(dbx, config, snapshot, new_only=False, refetch=False):
+    """ Hashes the files of a snapshot again and compares them with its manifest or journal. """
+    global error_log_path
+    if not snapshot:
+        manifests = snapshot_manifests(config.folder)
+        if not manifests:
+            logging.error( 'No snapshot to verify in ' + config.folder )
+            sys.exit(1)
+        snapshot = manifests[-1][0]
+    path = os.path.join(config.folder, snapshot.rstrip('/'))
+    manifest = Manifest.open(path)
+    if manifest and manifest.has_blocks() and not os.path.isdir(path):
+        return verify_blocks(config, manifest)
+    if not os.path.isdir(path):
+        logging.error( 'No such snapshot: ' + snapshot )
+        sys.exit(1)
+    checkpoint = time.time()
+    expected = {} # remote path: (size, rev, content_hash)
+    if manifest and not new_only:
+        for remote_path, size, rev, file_hash in manifest.files():
+            expected[remote_path] = (size, rev, file_hash)
+    elif os.path.isfile(path.replace('.incomplete', '') + '.job'):
+        header, done, records, scanned = JobJournal.replay(path.replace('.incomplete', '') + '.job')
+        for record in records:
+            if record['op'] in ['+', 'u'] and not record['path'].endswith(u'/') and record['id'] in done:
+                expected[record['path']] = (record['size'], record['rev'], record['hash'])
+    else:
+        logging.error( 'No manifest or job to verify against: ' + snapshot )
+        sys.exit(1)
+    root = unicode_path(path)
+    error_log_path = path.replace('.incomplete', '') + '.errors'
+    since = time.time() - VERIFY_INTERVAL
+    inodes = {} # (dev, inode): remote paths
+    failed = []
+    skipped = 0
+    unknown = 0
+    for remote_path, (size, rev, file_hash) in sorted(expected.iteritems()):
+        if not file_hash:
+            unknown += 1
+            continue
+        try:
+            st = os.lstat(root + remote_path)
+        except OSError:
+            print 'Missing: ' + remote_path.encode('utf8')
+            log_error(remote_path, 'Missing from the snapshot')
+            failed.append(remote_path)
+            continue
+        if hash_cache.verified(st, since) == file_hash:
+            skipped += 1
+            continue
+        inodes.setdefault((st.st_dev, st.st_ino), []).append(remote_path)
+    groups = dict((root + paths[0], paths) for paths in inodes.itervalues())
+    verified = 0
+    verified_bytes = 0
+    pool = multiprocessing.Pool(config.fs_workers)
+    try:
+        for local_file_path, actual, error in pool.imap_unordered(hash_file_mapped, groups.keys(), 16):
+            ok = True
+            for remote_path in groups[local_file_path]:
+                size, rev, file_hash = expected[remote_path]
+                if actual != file_hash:
+                    ok = False
+                    print 'Mismatch: %s (%s)' % (remote_path.encode('utf8'), error or 'content_hash %s, expected %s' % (actual, file_hash))
+                    log_error(remote_path, error or 'content_hash %s does not match %s' % (actual, file_hash))
+                    failed.append(remote_path)
+            if actual:
+                st = os.lstat(local_file_path)
+                if ok:
+                    hash_cache.put_verified(st, actual)
+                    verified += len(groups[local_file_path])
+                    verified_bytes += st.st_size
+                else:
+                    hash_cache.put(st, actual) # A full compare will see what the file really holds
+    finally:
+        pool.terminate()
+        pool.join()
+    hash_cache.commit()
+    print 'Verified %i files (%s) in %s: %i failed, %i skipped as verified before, %i without a content_hash' % (
+        verified, human_size(verified_bytes), human_time(time.time()-checkpoint), len(failed), skipped, unknown)
+    if failed and refetch:
+        refetched = 0
+        for remote_path in failed:
+            size, rev, file_hash = expected[remote_path]
+            local_file_path = root + remote_path
+            if not os.path.isdir(os.path.dirname(local_file_path)):
+                os.makedirs(os.path.dirname(local_file_path))
+            download_file(dbx, local_file_path, remote_path, size, None, rev)
+            if os.path.isfile(local_file_path) and content_hash(local_file_path) == file_hash:
+                hash_cache.put_verified(os.lstat(local_file_path), file_hash)
+                refetched += 1
+        hash_cache.commit()
+        print 'Downloaded again: %i of %i files' % (refetched, len(failed))
+
+def verify_blocks(config, manifest):
+    """ Checks every block of a snapshot of the chunks backend against its digest, in a process pool. """
+    checkpoint = time.time()
+    store = ChunkStore(os.path.join(config.folder, CHUNKS_FOLDER))
+    digests = dict((store.block_path(digest), digest) for digest in manifest.distinct_blocks())
+    failed = 0
+    pool = multiprocessing.Pool(config.fs_workers)
+    try:
+        for block_path, actual, error in pool.imap_unordered(hash_block, digests.keys(), 16):
+            if actual == digests[block_path]:
+                continue
+            failed += 1
+            print 'Bad block: %s (%s)' % (block_path, error or 'SHA-256 %s' % actual)
+            for path in manifest.files_using(digests[block_path]):
+                print '  used by ' + path.encode('utf8')
+    finally:
+        pool.terminate()
+        pool.join()
+    print 'Verified %i blocks in %s: %i failed' % (len(digests), human_time(time.time()-checkpoint), failed)
+    store.close()
+
+class FolderTotals:
+    """ Files and bytes in a folder and its subfolders, all of them and those to download. """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.downloads = 0
+        self.download_bytes = 0
+
+def parent_folders(path):
+    """ Yields the folders containing path, innermost first, with trailing slashes. """
+    while path.rstrip(u'/'):
+        path = path.rstrip(u'/').rsplit(u'/', 1)[0] + u'/'
+        yield path
+
+def plan_bundles(totals, min_files, scanned):
+    """ Picks the outermost folders worth downloading as one zip. """
+    scanned = tuple(folder.rstrip(u'/') + u'/' for folder in scanned)
+    bundles = []
+    for folder in sorted(totals):
+        if folder == u'/' or (bundles and folder.startswith(bundles[-1])):
+            continue
+        if not folder.startswith(scanned):
+            continue
+        folder_totals = totals[folder]
+        if folder_totals.downloads < min_files:
+            continue
+        if folder_totals.files > ZIP_MAX_FILES or folder_totals.bytes > ZIP_MAX_SIZE:
+            continue
+        if folder_totals.download_bytes < ZIP_MIN_CHANGED * folder_totals.bytes:
+            continue
+        bundles.append(folder)
+    return bundles
+
+def member_blocks(archive, member):
+    """ Yields the content of a zip member in blocks of HASH_BLOCK_SIZE. """
+    source = archive.open(member)
+    try:
+        while True:
+            block = source.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            yield block
+    finally:
+        source.close()
+
+def download_bundle(dbx, remote_folder, files, spool_folder):
+    """ Downloads remote_folder as a zip and extracts files. Returns the files that were not extracted. """
+    global update_count, update_bytes, queue_bytes
+    wanted = {}
+    for local_file_path, entry in files:
+        wanted[entry['path'].lower()] = (local_file_path, entry)
+    status(remote_folder.encode('utf8') + ' (zip)')
+    spool = tempfile.TemporaryFile(dir=spool_folder)
+    try:
+        try:
+            metadata, response = api_call(dbx.files_download_zip, remote_folder.rstrip(u'/'))
+            try:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+            finally:
+                response.close()
+            archive = zipfile.ZipFile(spool)
+        except (dropbox.exceptions.ApiError, requests.exceptions.RequestException, zipfile.BadZipfile) as e:
+            logging.warning( 'Zip download failed, downloading one by one: %s %s' % (remote_folder.encode('utf8'), e) )
+            return files
+        # Members are named from the folder itself: /Photos/a.jpg is Photos/a.jpg
+        parent = remote_folder.rstrip(u'/').rsplit(u'/', 1)[0]
+        for member in archive.infolist():
+            name = member.filename
+            if not isinstance(name, unicode):
+                name = name.decode('utf8')
+            path_lower = (parent + u'/' + name).lower()
+            if not path_lower in wanted:
+                continue
+            local_file_path, entry = wanted[path_lower]
+            if local_file_path is None:
+                # Blocks are only stored once the content_hash matches, a file in one block is read once
+                blocks = list(member_blocks(archive, member)) if member.file_size <= HASH_BLOCK_SIZE else None
+                digests = [hashlib.sha256(block).hexdigest() for block in blocks or member_blocks(archive, member)]
+                if ChunkStore.content_hash(digests) != entry['hash']:
+                    continue # Changed since it was listed, the listed rev is downloaded instead
+                for digest, block in zip(digests, blocks or member_blocks(archive, member)):
+                    chunk_store.put(digest, block)
+                journal.done(entry['id'], digests)
+            else:
+                part_path = local_file_path + u'.part'
+                hasher = ContentHasher()
+                with open(part_path, 'wb') as part:
+                    source = archive.open(member)
+                    while True:
+                        data = source.read(DOWNLOAD_CHUNK_SIZE)
+                        if not data:
+                            break
+                        hasher.update(data)
+                        part.write(data)
+                    source.close()
+                if hasher.hexdigest() != entry['hash']:
+                    # Changed since it was listed, the listed rev is downloaded instead
+                    os.remove(part_path)
+                    continue
+                os.rename(part_path, local_file_path)
+                set_mtime(local_file_path, datetime.datetime.strptime(entry['mtime'], '%Y-%m-%dT%H:%M:%SZ'))
+                if hash_cache:
+                    hash_cache.put(os.stat(local_file_path), entry['hash'])
+                journal.done(entry['id'])
+            del wanted[path_lower]
+            with stats_lock:
+                update_count += 1
+                update_bytes += entry['size']
+                queue_bytes -= entry['size']
+            status(entry['path'].encode('utf8') + ' (zip)')
+    finally:
+        spool.close()
+    return wanted.values()
+
+class ByteBudget:
+    """ Limits the number of bytes being downloaded at once. """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+class DownloadPool:
+    """ Runs download_file on a number of worker threads. """
+    def __init__(self, dbx, workers, max_inflight):
+        self.tasks = Queue.Queue(maxsize=workers*2)
+        self.budget = ByteBudget(max_inflight)
+        self.error = None
+        session = dropbox.create_session(max_connections=workers)
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self.work, args=(dbx.clone(session=session),))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, local_file_path, remote_path, size, job_id=None, rev=None):
+        task = (local_file_path, remote_path, size, job_id, rev)
+        while not self.error:
+            try:
+                self.tasks.put(task, timeout=1.0) # A timeout keeps the main thread interruptible
+                return
+            except Queue.Full:
+                pass
+        self.raise_error()
+
+    def work(self, dbx):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            local_file_path, remote_path, size, job_id, rev = task
+            if self.error:
+                continue
+            self.budget.acquire(size)
+            try:
+                download_file(dbx, local_file_path, remote_path, size, job_id, rev)
+            except:
+                self.error = sys.exc_info()
+            finally:
+                self.budget.release(size)
+
+    def join(self):
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1.0)
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+class JobApplier:
+    """ Carries out job entries as they are planned or replayed. """
+    def __init__(self, snapshot_incomplete, fs, sink=None, spool_folder=None, store=None):
+        self.root = snapshot_incomplete.decode('utf8')
+        self.fs = fs
+        self.sink = sink
+        self.store = store
+        if spool_folder:
+            self.download_queue = ExternalSort(spool_folder)
+            self.link_queue = ExternalSort(spool_folder)
+            self.totals = None
+        else:
+            self.download_queue = []
+            self.link_queue = []
+            self.totals = collections.defaultdict(FolderTotals)
+
+    def downloads(self):
+        """ Yields (size, local_file_path, entry) for every queued download, smallest first. """
+        if isinstance(self.download_queue, ExternalSort):
+            for (size, local_file_path), entry in self.download_queue:
+                yield size, local_file_path, entry
+        else:
+            self.download_queue.sort()
+            for item in self.download_queue:
+                yield item
+
+    def links(self):
+        """ Yields (source, local_file_path, entry) for every queued hardlink. """
+        if isinstance(self.link_queue, ExternalSort):
+            for local_file_path, (source, entry) in self.link_queue:
+                yield source, local_file_path, entry
+        else:
+            for item in self.link_queue:
+                yield item
+
+    def apply(self, entry, done=False):
+        action = entry['op']
+        path = entry['path']
+        local_path = os.path.join(self.root, path.lstrip(u'/'))
+        if self.totals is not None and action != '-' and not path.endswith(u'/'):
+            for folder in parent_folders(path):
+                self.totals[folder].files += 1
+                self.totals[folder].bytes += entry['size']
+        if action == ' ' or done:
+            if action != '-' and not path.endswith(u'/'):
+                dedup_index.add(entry['hash'], local_path)
+            return
+        logging.info( action + ' ' + local_path.encode('utf8') )
+        if action in ['-', 'u']:
+            try:
+                self.fs.remove(local_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT: # Already removed by an interrupted run
+                    raise
+        if action == '+' and path.endswith(u'/'):
+            try:
+                os.makedirs(local_path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    logging.error( 'Could not create %s: %s' % (local_path.encode('utf8'), e) )
+                    log_error(path, str(e))
+        if action in ['+', 'u'] and not path.endswith(u'/'):
+            self.queue_download(entry, local_path)
+        else:
+            journal.done(entry['id'])
+
+    def queue_download(self, entry, local_file_path):
+        global job_size
+        # Content already in a snapshot, or queued earlier in this run, is linked after the downloads
+        source = dedup_index.get(entry['hash'])
+        if source is not None:
+            self.queue_link(source, local_file_path, entry)
+            return
+        dedup_index.add(entry['hash'], self.source_of(entry, local_file_path))
+        job_size += entry['size']
+        if self.totals is not None:
+            for folder in parent_folders(entry['path']):
+                self.totals[folder].downloads += 1
+                self.totals[folder].download_bytes += entry['size']
+        if self.sink:
+            self.sink(entry['size'], local_file_path, entry)
+        elif isinstance(self.download_queue, ExternalSort):
+            self.download_queue.add([entry['size'], local_file_path], entry)
+        else:
+            self.download_queue.append((entry['size'], local_file_path, entry))
+
+    def source_of(self, entry, local_file_path):
+        """ Returns what files with the same content are linked from once this one is downloaded. """
+        return local_file_path
+
+    def queue_link(self, source, local_file_path, entry):
+        if isinstance(self.link_queue, ExternalSort):
+            self.link_queue.add(local_file_path, [source, entry])
+        else:
+            self.link_queue.append((source, local_file_path, entry))
+
+    def link(self, dbx, source, local_file_path, entry):
+        """ Links a queued file from its source, or downloads it if the source is gone. """
+        global link_count, link_bytes
+        path = entry['path']
+        if isinstance(source, list):
+            # Blocks of a snapshot of the chunks backend, written into the mirror
+            status(path.encode('utf8')+' (from blocks)')
+            try:
+                write_blocks(self.store, source, local_file_path)
+            except (OSError, IOError) as e:
+                logging.warning( 'Downloading %s, its blocks could not be read: %s' % (path.encode('utf8'), e) )
+                download_file(dbx, local_file_path, path, entry['size'], entry['id'], entry['rev'])
+                return
+            set_mtime(local_file_path, datetime.datetime.strptime(entry['mtime'], '%Y-%m-%dT%H:%M:%SZ'))
+            if hash_cache:
+                hash_cache.put(os.stat(local_file_path), entry['hash'])
+        elif not os.path.isfile(source):
+            # The source was to be downloaded by this run, but failed
+            download_file(dbx, local_file_path, path, entry['size'], entry['id'], entry['rev'])
+            return
+        else:
+            status(path.encode('utf8')+' (linked)')
+            try:
+                link_file(source, local_file_path)
+            except (OSError, IOError) as e:
+                if getattr(e, 'errno', None) != errno.EEXIST: # Linked by an interrupted run
+                    log_error(path, str(e))
+                    return
+        journal.done(entry['id'])
+        link_count += 1
+        link_bytes += entry['size']
+
+class ChunkApplier(JobApplier):
+    """ JobApplier for the chunks backend without a mirror, where only blocks are written. """
+    def __init__(self, sink=None, spool_folder=None):
+        JobApplier.__init__(self, '', None, sink, spool_folder)
+        self.awaited = set() # Ids of the downloads that duplicates wait for
+        self.blocks = {}
+
+    def apply(self, entry, done=False):
+        path = entry['path']
+        if self.totals is not None and entry['op'] != '-' and not path.endswith(u'/'):
+            for folder in parent_folders(path):
+                self.totals[folder].files += 1
+                self.totals[folder].bytes += entry['size']
+        if not entry['op'] in ['+', 'u']:
+            return
+        if done:
+            dedup_index.add(entry['hash'], self.source_of(entry, None))
+            return
+        logging.info( entry['op'] + ' ' + path.encode('utf8') )
+        self.queue_download(entry, None)
+
+    def source_of(self, entry, local_file_path):
+        return entry['id']
+
+    def queue_link(self, source, local_file_path, entry):
+        global link_count, link_bytes
+        if isinstance(source, list):
+            # Already in the store
+            journal.done(entry['id'], source)
+            link_count += 1
+            link_bytes += entry['size']
+            return
+        self.awaited.add(int(source))
+        JobApplier.queue_link(self, source, local_file_path, entry)
+
+    def links(self):
+        # The blocks of a download are in its done line
+        if self.awaited:
+            journal.flush()
+            for record in JobJournal.read(journal.path):
+                if record.get('done') in self.awaited and 'blocks' in record:
+                    self.blocks[record['done']] = record['blocks']
+        return JobApplier.links(self)
+
+    def link(self, dbx, source, local_file_path, entry):
+        global link_count, link_bytes
+        blocks = self.blocks.get(int(source))
+        if blocks is None:
+            # The source was to be downloaded by this run, but failed
+            download_file(dbx, None, entry['path'], entry['size'], entry['id'], entry['rev'])
+            return
+        journal.done(entry['id'], blocks)
+        link_count += 1
+        link_bytes += entry['size']
+
+def new_snapshot_name():
+    """ Returns the name of a snapshot started now. """
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+
+def reset_counters():
+    """ Starts the counters and metrics of a run from zero, for the runs of a daemon after the first. """
+    global total_count, update_count, update_bytes, queue_bytes, listed_bytes, job_size, error_count, link_count, link_bytes
+    global journal, space_budget, dedup_index, metrics, checkpoint1
+    checkpoint1 = time.time()
+    total_count = update_count = update_bytes = queue_bytes = listed_bytes = job_size = 0
+    error_count = link_count = link_bytes = 0
+    journal = space_budget = dedup_index = None
+    metrics = Metrics()
+    rate_limiter.reset_stats()
+    del failed_parts[:]
+    if hash_cache:
+        hash_cache.hashed = 0
+
+def take_snapshot(dbx, config, fs, job=False):
+    """ Makes a new snapshot, or finishes the one of an interrupted run. Returns its path. """
+    global journal, space_budget, dedup_index, filters, link_count, link_bytes, checkpoint1, job_path, space, listed_bytes, job_size, error_log_path, checkpoint4
+    global chunk_store
+    reset_counters()
+    atexit.register(abort)
+    metrics.prom_path = os.path.join(config.folder, 'metrics.prom')
+    pruner = None
+    retained = []
+    applier = None
+    pool = None
+    expired = []
+    spool_folder = config.folder if config.low_memory else None
+    store = mirror = chunk_store = previous_manifest = None
+    if config.backend == 'chunks':
+        # Snapshots are manifests of blocks, with --mirror the files of the latest one are also kept as they are
+        store = ChunkStore(os.path.join(config.folder, CHUNKS_FOLDER))
+        if config.mirror:
+            mirror = os.path.join(config.folder.encode('utf8'), MIRROR_FOLDER)
+        else:
+            chunk_store = store
+            if os.path.isdir(os.path.join(config.folder.encode('utf8'), MIRROR_FOLDER)):
+                logging.warning( 'Removing the mirror of the chunks backend, --mirror is off' )
+                fs.remove(os.path.join(config.folder.encode('utf8'), MIRROR_FOLDER))
+    if job:
+        job_path = job
+        snapshot_previous = None
+        snapshot_now = job_path.replace('.job', '')
+        snapshot_incomplete = mirror if store else job_path.replace('.job', '.incomplete')
+        error_log_path = snapshot_now+'.errors'
+        metrics.json_path = snapshot_now+'.metrics.json'
+        checkpoint1 = time.time()
+        checkpoint2 = time.time()
+        checkpoint3 = time.time()
+        progress.phase('apply')
+    else:
+        logging.info( 'Space allocated: %s' % space )
+        logging.info( '\n[R] = Remote\n[L] = Local\n')
+        snapshot_now = os.path.join(config.folder.encode('utf8'), new_snapshot_name().encode('utf8'))
+        snapshot_previous = False
+        snapshot_count = 0
+        if store:
+            # Expired manifests are released at the end, once the blocks this run shares with them are retained
+            snapshot_previous, retained, expired = chunk_snapshots(config.folder, config.rotations, mirror)
+        else:
+            for snapshot in sorted(os.listdir(config.folder), reverse=True):
+                if snapshot.endswith('temp') or snapshot in [MIRROR_FOLDER, CHUNKS_FOLDER]:
+                    continue
+                snapshot = os.path.join(config.folder, snapshot)
+                if not os.path.isdir(snapshot):
+                    continue
+                snapshot_count += 1
+                if os.path.isdir(snapshot):
+                    if not snapshot_previous:
+                        snapshot_previous = snapshot
+                    elif snapshot_count > config.rotations:
+                        snapshot_name = snapshot.replace('.incomplete', '').replace('.temp', '')
+                        expired.append(snapshot)
+                        for ext in SNAPSHOT_FILES:
+                            if os.path.isfile(snapshot_name+ext):
+                                expired.append(snapshot_name+ext)
+                    else:
+                        retained.append(snapshot)
+            pruner = Pruner(expired, config.fs_workers)
+            pruner.start()
+
+        checkpoint1 = time.time()
+        progress.phase('clone')
+        snapshot_temp = snapshot_now+'.temp'
+        snapshot_incomplete = snapshot_now+'.incomplete'
+        job_path = snapshot_now+'.job'
+        error_log_path = snapshot_now+'.errors'
+        metrics.json_path = snapshot_now+'.metrics.json'
+        if store:
+            snapshot_incomplete = mirror
+            if mirror and not os.path.isdir(mirror):
+                os.makedirs(mirror)
+            if snapshot_previous:
+                logging.info( u'Previous snapshot: ' + snapshot_previous )
+        elif snapshot_previous:
+            logging.info( u'Previous snapshot: ' + snapshot_previous )
+            print( u'Creating new snapshot: ' + snapshot_now),
+            fs.clone(snapshot_previous, snapshot_temp, config.remote_folders)
+            os.rename(snapshot_temp, snapshot_incomplete)
+        checkpoint2 = time.time()
+        progress.phase('compare')
+        if not store:
+            print 'Created new snapshot in %s (%i files, %i folders linked)' % (human_time(checkpoint2-checkpoint1), fs.linked, fs.folders)
+        #print 'Getting Dropbox remote file list ...'
+        if chunk_store:
+            previous_manifest = Manifest.open(snapshot_previous) if snapshot_previous else None
+        dedup_index = DedupIndex(snapshot_incomplete, None if store else snapshot_previous, config.low_memory, ([snapshot_previous] if snapshot_previous else []) + retained)
+        journal = JobJournal(job_path)
+        journal.header(previous=snapshot_previous or None)
+        if config.pipeline:
+            # Downloads start as the compare finds them, the job is still written for -j
+            space_budget = SpaceBudget(config.folder, config.reserve*1024*1024)
+            pool = DownloadPool(dbx, config.workers, config.max_inflight*1024*1024)
+            def start_download(size, local_file_path, entry):
+                pool.put(local_file_path, entry['path'], size, entry['id'], entry['rev'])
+            if chunk_store:
+                applier = ChunkApplier(start_download, spool_folder)
+            else:
+                applier = JobApplier(snapshot_incomplete, fs, start_download, spool_folder, store)
+            journal.listener = applier.apply
+        filters = Filters(config.include, config.exclude, config.max_size, not_owned_folders(dbx) if config.own else ())
+        previous_cursors = read_cursors(snapshot_previous)
+        if previous_cursors and previous_cursors.get('filters') != Filters.settings(config):
+            logging.warning( 'Filters changed since the previous snapshot, falling back to a full scan' )
+            previous_cursors = {}
+        deferred = read_deferred(snapshot_previous)
+        cursors = {}
+        for remote_folder in config.remote_folders:
+            if chunk_store:
+                cursors[remote_folder] = compare_manifest(dbx, remote_folder, previous_manifest, previous_cursors.get(remote_folder), deferred)
+                continue
+            cursor = None
+            if remote_folder in previous_cursors:
+                logging.info( 'Listing changes since previous snapshot: ' + remote_folder )
+                cursor = compare_delta(dbx, remote_folder, snapshot_incomplete+remote_folder, previous_cursors[remote_folder], deferred)
+            if cursor is None:
+                cursor = compare_folder(dbx, remote_folder, snapshot_incomplete+remote_folder, config.fs_workers, spool_folder)
+            cursors[remote_folder] = cursor
+        if Filters.settings(config):
+            cursors['filters'] = Filters.settings(config) # Changed rules need a full scan
+        if not applier:
+            journal.close()
+        open(snapshot_now+'.cursor', 'w').write(json.dumps(cursors, indent=4))
+        checkpoint3 = time.time()
+        progress.phase('apply')
+        clear_line()
+        print '\rCompared %i items in %s' % (total_count, human_time(checkpoint3-checkpoint2))
+        if filters.skipped:
+            print 'Left out by filters: %i items' % filters.skipped
+    if not applier:
+        logging.info('Updating local file structure and queuing downloads')
+        header, done, entries, scanned = JobJournal.replay(job_path, spool_folder)
+        if job:
+            snapshot_previous = header.get('previous')
+            dedup_index = DedupIndex(snapshot_incomplete, None if store else snapshot_previous, config.low_memory, [snapshot_previous] if snapshot_previous else [])
+        journal = JobJournal(job_path)
+        if chunk_store:
+            applier = ChunkApplier(spool_folder=spool_folder)
+        else:
+            applier = JobApplier(snapshot_incomplete, fs, spool_folder=spool_folder, store=store)
+        for entry in entries:
+            applier.apply(entry, entry['id'] in done)
+    space = listed_bytes
+    if not space_budget:
+        space_budget = SpaceBudget(config.folder, config.reserve*1024*1024)
+    if not pool and not space_budget.fits(job_size):
+        if pruner and pruner.is_alive():
+            print 'Waiting for old snapshots to be removed'
+            while pruner.is_alive():
+                pruner.join(1.0)
+        if config.prune_early and not space_budget.fits(job_size):
+            make_room(job_size, config.folder, space_budget.reserve, reversed(retained), fs)
+        if not space_budget.fits(job_size):
+            print '%s to download, %s free: files that do not fit are deferred to the next run' % (human_size(job_size), human_size(disk_free(config.folder)))
+    checkpoint4 = time.time()
+    progress.phase('download')
+    bundles = []
+    if config.zip_min_files and not pool and applier.totals is not None:
+        bundles = plan_bundles(applier.totals, config.zip_min_files, scanned)
+        applier.totals.clear()
+    if bundles:
+        bundled = dict((folder, []) for folder in bundles)
+        queued = []
+        for size, local_file_path, entry in applier.download_queue:
+            for folder in parent_folders(entry['path']):
+                if folder in bundled:
+                    bundled[folder].append((local_file_path, entry))
+                    break
+            else:
+                queued.append((size, local_file_path, entry))
+        download_queue = applier.download_queue = queued
+        for folder in bundles:
+            files = bundled[folder]
+            if not space_budget.fits(2 * sum(entry['size'] for local_file_path, entry in files)):
+                # The zip is spooled next to its extracted files, one by one needs half the space
+                download_queue.extend((entry['size'], local_file_path, entry) for local_file_path, entry in files)
+                continue
+            logging.info( 'Downloading as zip: %s (%i files)' % (folder.encode('utf8'), len(files)) )
+            for local_file_path, entry in download_bundle(dbx, folder, files, config.folder):
+                download_queue.append((entry['size'], local_file_path, entry))
+    if pool:
+        pool.join()
+    elif config.workers > 1:
+        pool = DownloadPool(dbx, config.workers, config.max_inflight*1024*1024)
+        for size, local_file_path, entry in applier.downloads():
+            pool.put(local_file_path, entry['path'], size, entry['id'], entry['rev'])
+        pool.join()
+    else:
+        for size, local_file_path, entry in applier.downloads():
+            download_file(dbx, local_file_path, entry['path'], size, entry['id'], entry['rev'])
+    progress.phase('link')
+    for source, local_file_path, entry in applier.links():
+        applier.link(dbx, source, local_file_path, entry)
+    journal.close()
+    if space_budget.deferred:
+        space_budget.write(snapshot_now+'.deferred', job_path)
+    checkpoint5 = time.time()
+    progress.phase(None)
+    clear_line()
+    print '\rDownloaded %s in %s' % (human_size( update_bytes ), human_time(checkpoint5-checkpoint4))
+    for part_path in failed_parts:
+        if os.path.isfile(part_path):
+            os.remove(part_path) # Would be cloned into the next snapshot, which does not resume it
+    Manifest.write(snapshot_now, snapshot_incomplete, snapshot_previous, job_path, store)
+    if not store:
+        print '%s -> %s' % (snapshot_incomplete, snapshot_now)
+        os.rename(snapshot_incomplete, snapshot_now)
+    hash_cache.commit()
+    logging.info( 'Files hashed: %i' % hash_cache.hashed )
+    print 'Files/folders updated: %i/%i' % (update_count, total_count)
+    if link_count:
+        print 'Linked instead of downloaded: %i files, %s' % (link_count, human_size(link_bytes))
+    if space_budget.deferred:
+        print 'Deferred to the next run for lack of space: %i files, %s' % (len(space_budget.deferred), human_size(space_budget.deferred_bytes))
+    print rate_limiter.summary()
+    if pruner and pruner.paths:
+        if pruner.is_alive():
+            print 'Waiting for old snapshots to be removed'
+        while pruner.is_alive():
+            pruner.join(1.0)
+        print pruner.summary()
+    if previous_manifest:
+        previous_manifest.close()
+    if dedup_index:
+        dedup_index.close()
+    if store:
+        unfinished = False
+        for snapshot in expired:
+            logging.info( 'Removing old snapshot: ' + snapshot )
+            unfinished = unfinished or not os.path.isfile(Manifest.path_of(snapshot))
+            store.release(Manifest.path_of(snapshot), os.path.basename(snapshot))
+            for ext in SNAPSHOT_FILES:
+                if os.path.isfile(snapshot+ext):
+                    os.remove(snapshot+ext)
+        if chunk_store and (unfinished or error_count):
+            # Blocks of failed downloads, and of runs that were never finished, are in no manifest
+            store.sweep(unfinished_blocks(config.folder))
+        print store.summary()
+        store.close()
+    write_metrics(True)
+    atexit._exithandlers = []
+    return snapshot_now
+
+class ChangeWatcher(threading.Thread):
+    """ Sets changed when longpoll reports changes under one remote folder. """
+    def __init__(self, dbx, remote_folder, cursor, changed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # Longpoll blocks for longer than other calls may take
+        self.dbx = dbx.clone(session=dropbox.create_session(max_connections=1), timeout=LONGPOLL_TIMEOUT+120)
+        self.remote_folder = remote_folder
+        self.cursor = cursor
+        self.changed = changed
+
+    def run(self):
+        attempt = 0
+        while True:
+            try:
+                if self.cursor is None:
+                    self.cursor = api_call(self.dbx.files_list_folder_get_latest_cursor, self.remote_folder.rstrip(u'/'), recursive=True).cursor
+                result = self.dbx.files_list_folder_longpoll(self.cursor, LONGPOLL_TIMEOUT)
+                if result.changes:
+                    wanted = False
+                    for page in list_folder_pages(self.dbx, self.remote_folder, self.cursor):
+                        self.cursor = page.cursor
+                        wanted = wanted or not filters or any(filters.wanted(entry) for entry in page.entries)
+                    if wanted:
+                        logging.info( 'Changes in ' + self.remote_folder.encode('utf8') )
+                        self.changed.set()
+                attempt = 0
+                if result.backoff:
+                    time.sleep(result.backoff)
+            except (dropbox.exceptions.DropboxException, requests.exceptions.RequestException) as e:
+                attempt += 1
+                if isinstance(e, dropbox.exceptions.ApiError):
+                    # The cursor was reset, whatever changed is picked up by the next snapshot
+                    logging.warning( 'Longpoll cursor for %s is no longer valid: %s' % (self.remote_folder.encode('utf8'), e) )
+                    self.cursor = None
+                    self.changed.set()
+                else:
+                    logging.warning( 'Longpoll failed for %s: %s' % (self.remote_folder.encode('utf8'), e) )
+                time.sleep(min(API_RETRY_DELAY * 2 ** attempt, API_RETRY_MAX_DELAY))
+
+def run_daemon(dbx, config, fs, job=False):
+    """ Makes a snapshot whenever the remote folders have changed and settled for quiet_period seconds. """
+    global space
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        snapshot_now = take_snapshot(dbx, config, fs, job)
+        changed = threading.Event()
+        cursors = read_cursors(snapshot_now)
+        watchers = []
+        for remote_folder in config.remote_folders:
+            watchers.append(ChangeWatcher(dbx, remote_folder, cursors.get(remote_folder), changed))
+            watchers[-1].start()
+        while True:
+            print 'Waiting for changes'
+            while not changed.wait(1.0): # A timeout keeps the main thread interruptible
+                for i, watcher in enumerate(watchers):
+                    if not watcher.is_alive():
+                        logging.error( 'Change watcher for %s stopped, starting a new one' % watcher.remote_folder.encode('utf8') )
+                        watchers[i] = ChangeWatcher(dbx, watcher.remote_folder, watcher.cursor, changed)
+                        watchers[i].start()
+                        changed.set()
+            first_change = time.time()
+            changed.clear()
+            while changed.wait(config.quiet_period) and time.time() - first_change < DAEMON_MAX_DELAY:
+                changed.clear()
+            while new_snapshot_name() == os.path.basename(snapshot_now):
+                time.sleep(1.0) # Snapshots are named by the minute
+            try:
+                space = api_call(dbx.users_get_space_usage).used # Progress of the compare is shown against it
+                snapshot_now = take_snapshot(dbx, config, fs)
+            except Exception as e:
+                logging.exception( 'Snapshot failed, trying again after the next change: %s' % e )
+                abort()
+                atexit._exithandlers = []
+    finally:
+        if os.path.isfile(config.lockfile) and open(config.lockfile).read() == str(os.getpid()):
+            os.remove(config.lockfile)
 
 def main():
-    global uid, args, queue, queue_bytes, checkpoint1, job_path, space, listed_bytes, job_size, error_log_path, checkpoint4
+    global uid, args, queue, journal, space_budget, compare_mode, hash_cache, dedup_index, link_count, link_bytes, queue_bytes, checkpoint1, job_path, space, listed_bytes, job_size, error_log_path, checkpoint4
     parser = argparse.ArgumentParser(description=description)
     #parser.add_argument("-d", "--delay", help="Set a specific delay (in seconds) between calls, to stay below API rate limits.", type=float, default=False)
     parser.add_argument("-c", "--config", help="Read/write to a custom config file (default: " + default_config_path + ")", default=default_config_path)
@@ -330,8 +3240,36 @@ def main():
     parser.add_argument("-l", "--lockfile", help="By default, only one instance of this program should run at once. If you know what your are doing, you can set different lockfile paths for separate instances.", default=False)
     parser.add_argument("-t", "--token_path", help="Read/write to a custom token file (default: " + default_token_path + ")", default=False)
     #parser.add_argument("-n", "--do_nothing", help="Do not write anything to disk. Only show what would be done.", action="store_true")
-    parser.add_argument("-o", "--own", help="Only download files owned by current Dropbox user.", action="store_true")
+    parser.add_argument("-o", "--own", help="Only download files owned by current Dropbox user. Shared folders owned by others are still listed, but left out of the snapshot.", action="store_true")
     parser.add_argument("-a", "--all", help="Download all files in shared resources. (opposite of -o)", action="store_true")
+    parser.add_argument("--include", help="Only keep the paths matching this glob, and the folders leading to them. Can be repeated, replaces the includes in the config", action="append", metavar='GLOB')
+    parser.add_argument("--exclude", help="Leave out the paths matching this glob and everything below them, e.g. node_modules or '/Videos/**/*.mov'. Can be repeated, replaces the excludes in the config", action="append", metavar='GLOB')
+    parser.add_argument("--max_size", help="Leave out files larger than this many MiB, 0 disables (default: 0)", type=int)
+    parser.add_argument("--no_filters", help="Remove the include, exclude and max_size rules from the config", action="store_true")
+    parser.add_argument("--compare", help="How unchanged files are detected: by content hash, or by modification time and size (default: hash)", choices=['hash', 'mtime'])
+    parser.add_argument("-w", "--workers", help="Number of files to download at once (default: 1)", type=int)
+    parser.add_argument("-m", "--max_inflight", help="Maximum MiB being downloaded at once by all workers (default: 256)", type=int)
+    parser.add_argument("-p", "--pipeline", help="Start downloading while the compare is still running (no zip bundles, no space check up front)", action="store_true")
+    parser.add_argument("--no_pipeline", help="Compare first, then download (default, opposite of -p)", action="store_true")
+    parser.add_argument("--zip_min_files", help="Download folders with at least this many new files as one zip, 0 disables (default: 100)", type=int)
+    parser.add_argument("--reserve", help="MiB of free space kept on the backup disk, files that do not fit are deferred to the next run (default: 1024)", type=int)
+    parser.add_argument("--prune_early", help="Remove the oldest snapshots before their rotation when a run needs the space", action="store_true")
+    parser.add_argument("--no_prune_early", help="Never remove snapshots before their rotation (default, opposite of --prune_early)", action="store_true")
+    parser.add_argument("--low_memory", help="Sort listings and queues on disk in the backup folder, so memory use does not grow with the account (no zip bundles)", action="store_true")
+    parser.add_argument("--no_low_memory", help="Keep listings and queues in memory (default, opposite of --low_memory)", action="store_true")
+    parser.add_argument("--backend", help="How snapshots are stored: as hardlinked folders, or as manifests of compressed, deduplicated 4 MiB blocks that downloads are streamed into (default: hardlinks)", choices=['hardlinks', 'chunks'])
+    parser.add_argument("--mirror", help="With the chunks backend, also keep the files of the latest snapshot as they are, in a folder named latest. It takes as much disk space again as the remote folders", action="store_true")
+    parser.add_argument("--no_mirror", help="Keep the chunks backend to its blocks and manifests, and remove the mirror (default, opposite of --mirror)", action="store_true")
+    parser.add_argument("--restore", help="Write the files of a snapshot of the chunks backend to a folder", nargs=2, metavar=('SNAPSHOT', 'FOLDER'))
+    parser.add_argument("--verify", help="Hash the files of a snapshot again, the newest one by default, and report those that do not match its manifest", nargs='?', const='', metavar='SNAPSHOT')
+    parser.add_argument("--new_only", help="With --verify, only check the files downloaded by the run that made the snapshot", action="store_true")
+    parser.add_argument("--refetch", help="With --verify, download the files that failed again", action="store_true")
+    parser.add_argument("--diff", help="List the files added, removed and changed between two snapshots, by name or path", nargs=2, metavar='SNAPSHOT')
+    parser.add_argument("--history", help="List the versions of a remote file held by the snapshots", metavar='PATH')
+    parser.add_argument("--find", help="List the snapshot files with this content_hash (or its first digits), or the content of this local file", metavar='HASH')
+    parser.add_argument("--daemon", help="Keep running: make a snapshot, then a new one whenever the remote folders change", action="store_true")
+    parser.add_argument("--quiet_period", help="Seconds without further changes that a daemon waits before a snapshot (default: 60)", type=int)
+    parser.add_argument("--fs_workers", help="Number of threads indexing, creating and removing local snapshots, and of processes hashing for --verify (default: 8)", type=int)
     parser.add_argument("-v", "--verbose", help="Verbose output.", action="store_true")
     parser.add_argument("-d", "--debug", help="Extra verbose output.", action="store_true")
     args = parser.parse_args()
@@ -389,6 +3327,80 @@ def main():
         config_dict['own'] = False
     elif not 'own' in config_dict.keys():
         config_dict['own'] = False
+    if args.no_filters:
+        config_dict['include'] = []
+        config_dict['exclude'] = []
+        config_dict['max_size'] = 0
+    if args.include:
+        config_dict['include'] = [pattern.decode('utf8') for pattern in args.include]
+    elif not 'include' in config_dict.keys():
+        config_dict['include'] = []
+    if args.exclude:
+        config_dict['exclude'] = [pattern.decode('utf8') for pattern in args.exclude]
+    elif not 'exclude' in config_dict.keys():
+        config_dict['exclude'] = []
+    if args.max_size is not None:
+        config_dict['max_size'] = args.max_size
+    elif not 'max_size' in config_dict.keys():
+        config_dict['max_size'] = 0
+    if args.compare:
+        config_dict['compare'] = args.compare
+    elif not 'compare' in config_dict.keys():
+        config_dict['compare'] = 'hash'
+    if not 'hash_cache' in config_dict.keys():
+        config_dict['hash_cache'] = os.path.join(os.path.dirname(args.config), 'hashcache.db')
+    if args.workers:
+        config_dict['workers'] = args.workers
+    elif not 'workers' in config_dict.keys():
+        config_dict['workers'] = 1
+    if args.max_inflight:
+        config_dict['max_inflight'] = args.max_inflight
+    elif not 'max_inflight' in config_dict.keys():
+        config_dict['max_inflight'] = 256
+    if args.pipeline:
+        config_dict['pipeline'] = True
+    elif args.no_pipeline:
+        config_dict['pipeline'] = False
+    elif not 'pipeline' in config_dict.keys():
+        config_dict['pipeline'] = False
+    if args.zip_min_files is not None:
+        config_dict['zip_min_files'] = args.zip_min_files
+    elif not 'zip_min_files' in config_dict.keys():
+        config_dict['zip_min_files'] = 100
+    if args.reserve is not None:
+        config_dict['reserve'] = args.reserve
+    elif not 'reserve' in config_dict.keys():
+        config_dict['reserve'] = 1024
+    if args.prune_early:
+        config_dict['prune_early'] = True
+    elif args.no_prune_early:
+        config_dict['prune_early'] = False
+    elif not 'prune_early' in config_dict.keys():
+        config_dict['prune_early'] = False
+    if args.low_memory:
+        config_dict['low_memory'] = True
+    elif args.no_low_memory:
+        config_dict['low_memory'] = False
+    elif not 'low_memory' in config_dict.keys():
+        config_dict['low_memory'] = False
+    if args.backend:
+        config_dict['backend'] = args.backend
+    elif not 'backend' in config_dict.keys():
+        config_dict['backend'] = 'hardlinks'
+    if args.mirror:
+        config_dict['mirror'] = True
+    elif args.no_mirror:
+        config_dict['mirror'] = False
+    elif not 'mirror' in config_dict.keys():
+        config_dict['mirror'] = False
+    if args.quiet_period is not None:
+        config_dict['quiet_period'] = args.quiet_period
+    elif not 'quiet_period' in config_dict.keys():
+        config_dict['quiet_period'] = 60
+    if args.fs_workers:
+        config_dict['fs_workers'] = args.fs_workers
+    elif not 'fs_workers' in config_dict.keys():
+        config_dict['fs_workers'] = 8
 
     width_key = 0
     width_value = 0
@@ -412,6 +3424,12 @@ def main():
     if not 'folder' in config_dict.keys():
         logging.error( 'Error: No root folder for local backups. Use the -f option to set.' )
         sys.exit(1)
+    if args.diff or args.history or args.find:
+        query_manifests(config, args)
+        return
+    if args.restore:
+        restore_snapshot(config, args.restore[0], args.restore[1])
+        return
     if os.path.isfile(config.lockfile):
         other_pid = open(config.lockfile).read()
         if check_pid(int(other_pid)):
@@ -422,6 +3440,13 @@ def main():
     except IOError as e:
         logging.error( str(e) )
         sys.exit(1)
+    compare_mode = config.compare
+    hash_cache = HashCache(config.hash_cache)
+    if args.verify is not None:
+        dbx = login(config.token_path) if args.refetch else None
+        verify_snapshot(dbx, config, args.verify, args.new_only, args.refetch)
+        hash_cache.close()
+        return
     dbx = login(config.token_path)
     #pprint.pprint(dir(dbx))
     account_info = dbx.users_get_current_account()
@@ -429,110 +3454,13 @@ def main():
     #print repr(account_info.account_id)
     uid = account_info.account_id
     logging.info( 'Logged in as %s, uid: %s' % (account_info.email, uid) )
-    atexit.register(abort)
-    if args.job:
-        job_path = args.job
-        snapshot_now = job_path.replace('.job', '')
-        snapshot_incomplete = job_path.replace('.job', '.incomplete')
-        error_log_path = snapshot_now+'.errors'
-        checkpoint1 = time.time()
-        checkpoint2 = time.time()
-        checkpoint3 = time.time()
+    progress.start()
+    fs = SnapshotFS(config.fs_workers)
+    if args.daemon:
+        run_daemon(dbx, config, fs, args.job)
     else:
-        logging.info( 'Space allocated: %s' % space )
-        logging.info( '\n[R] = Remote\n[L] = Local\n')
-        snapshot_now = os.path.join(config.folder.encode('utf8'), datetime.datetime.now().strftime("%Y-%m-%d %H:%M").encode('utf8'))
-        snapshot_previous = False
-        snapshot_count = 0
-        for snapshot in sorted(os.listdir(config.folder), reverse=True):
-            if snapshot.endswith('temp'):
-                continue
-            snapshot = os.path.join(config.folder, snapshot)
-            if not os.path.isdir(snapshot):
-                continue
-            snapshot_count += 1
-            if os.path.isdir(snapshot):
-                if not snapshot_previous:
-                    snapshot_previous = snapshot
-                elif snapshot_count > config.rotations:
-                    snapshot_job = snapshot.replace('.incomplete', '').replace('.temp', '') + '.job'
-                    cmd = ['rm', '-r', snapshot]
-                    if os.path.isfile(snapshot_job):
-                        cmd.append(snapshot_job)
-                    print ('Removing old snapshot: ' + snapshot)
-                    subprocess.call(cmd)
-
-        checkpoint1 = time.time()
-        snapshot_temp = snapshot_now+'.temp'
-        snapshot_incomplete = snapshot_now+'.incomplete'
-        job_path = snapshot_now+'.job'
-        error_log_path = snapshot_now+'.errors'
-        if snapshot_previous:
-            logging.info( u'Previous snapshot: ' + snapshot_previous )
-            cmd = ['cp', '-al', snapshot_previous, snapshot_temp]
-            print( u'Creating new snapshot: ' + snapshot_now),
-            logging.info( ' '.join(cmd) )
-            subprocess.call(cmd)
-            os.rename(snapshot_temp, snapshot_incomplete)
-        checkpoint2 = time.time()
-        print 'Created new snapshot in %s' % (human_time(checkpoint2-checkpoint1))
-        #print 'Getting Dropbox remote file list ...'
-        for remote_folder in config.remote_folders:
-            compare_folder(dbx, remote_folder, snapshot_incomplete+remote_folder, job_path)
-        checkpoint3 = time.time()
-        clear_line()
-        print '\rCompared %i items in %s' % (total_count, human_time(checkpoint3-checkpoint2))
-    logging.info('Updating local file structure and queuing downloads')
-    download_queue = {}
-    for line in open(job_path):
-        line = line.rstrip()
-        if line.startswith('#') or line == '':
-            continue
-        action = line[0]
-        path = line[2:]
-        local_path = os.path.join(snapshot_incomplete, path.lstrip('/'))
-        if path.endswith('/'): # is folder
-            if args.job and os.path.exists(local_path):
-                continue
-            if action == '-':
-                cmd = ['rm', '-rv', local_path]
-                logging.info( '- ' + local_path)
-                subprocess.call(cmd)
-            elif action == '+':
-                logging.info( '+ ' + local_path)
-                try:
-                    os.makedirs(local_path)
-                except OSError as e:
-                    print str(e)
-        else:
-            path, size = path.rsplit(' ', 1)
-            size = int(size)
-            local_path = os.path.join(snapshot_incomplete, path.lstrip('/'))
-            if args.job and os.path.exists(local_path):
-                continue
-            if action == '-':
-                logging.info( '- ' + local_path)
-                os.remove(local_path)
-            elif action == 'u':
-                os.remove(local_path)
-                logging.info( 'u ' + local_path)
-                download_queue[path.decode('utf8')] = size
-                job_size += size
-            elif action == '+':
-                logging.info( '+ ' + local_path)
-                download_queue[path.decode('utf8')] = size
-                job_size += size
-    space = listed_bytes
-    checkpoint4 = time.time()
-    for path, size in sorted(download_queue.items(), key=operator.itemgetter(1)):
-        download_file(dbx, os.path.join(snapshot_incomplete.decode('utf8'), path.lstrip(u'/')), path, size, skip_existing=args.job)
-    checkpoint5 = time.time()
-    clear_line()
-    print '\rDownloaded %s in %s' % (human_size( update_bytes ), human_time(checkpoint5-checkpoint4))
-    print '%s -> %s' % (snapshot_incomplete, snapshot_now)
-    os.rename(snapshot_incomplete, snapshot_now)
-    print 'Files/folders updated: %i/%i' % (update_count, total_count)
-    atexit._exithandlers = []
+        take_snapshot(dbx, config, fs, args.job)
+    hash_cache.close()
 
 if __name__ == '__main__':
     main()
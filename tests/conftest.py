@@ -0,0 +1,29 @@
+import datetime
+import hashlib
+import imp
+import os
+
+import pytest
+from dropbox.files import DeletedMetadata, FileMetadata, FolderMetadata
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dropbox-snapshot.py')
+
+@pytest.fixture(scope='session')
+def ds():
+    """ The script, loaded as a module. """
+    return imp.load_source('dropbox_snapshot', SCRIPT)
+
+def content_hash(data):
+    blocks = ''.join(hashlib.sha256(data[i:i+4*1024*1024]).digest() for i in xrange(0, len(data), 4*1024*1024))
+    return hashlib.sha256(blocks).hexdigest()
+
+def file_entry(path, data='', client_modified=datetime.datetime(2020, 1, 1)):
+    return FileMetadata(name=path.rsplit(u'/', 1)[1], id=u'id:' + path, path_lower=path.lower(), path_display=path,
+        client_modified=client_modified, server_modified=client_modified,
+        rev='%09x' % (abs(hash(data)) % 10**9), size=len(data), content_hash=content_hash(data))
+
+def folder_entry(path):
+    return FolderMetadata(name=path.rsplit(u'/', 1)[1], id=u'id:' + path, path_lower=path.lower(), path_display=path)
+
+def deleted_entry(path):
+    return DeletedMetadata(name=path.rsplit(u'/', 1)[1], path_lower=path.lower(), path_display=path)
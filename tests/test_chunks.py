@@ -0,0 +1,82 @@
+import datetime
+import hashlib
+import os
+
+import pytest
+
+from conftest import content_hash
+
+MTIME = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+@pytest.fixture
+def store(ds, tmpdir):
+    store = ds.ChunkStore(str(tmpdir.join(ds.CHUNKS_FOLDER)))
+    yield store
+    store.close()
+
+def write_snapshot(ds, store, folder, name, files, previous=None):
+    """ Writes the journal and manifest of a chunks snapshot without a mirror, changing files from previous. """
+    snapshot = os.path.join(str(folder), name)
+    journal = ds.JobJournal(snapshot + '.job')
+    journal.header()
+    for path, data in sorted(files.items()):
+        if data is None:
+            journal.plan('-', path)
+            continue
+        part = folder.join('download.part')
+        part.write(data)
+        item = ds.RemoteFile(path.rsplit(u'/', 1)[1], len(data), MTIME, content_hash(data), 'rev')
+        journal.done(journal.plan('+', path, item), store.put_file(str(part)))
+        part.remove()
+    journal.close()
+    ds.Manifest.write(snapshot, None, previous, snapshot + '.job', store)
+    return snapshot
+
+def stored_blocks(store):
+    return sorted(name for prefix in os.listdir(store.folder) if len(prefix) == 2 for name in os.listdir(os.path.join(store.folder, prefix)))
+
+def block(data):
+    return hashlib.sha256(data).hexdigest()
+
+def test_put_file_stores_each_block_once(ds, store, tmpdir):
+    data = 'a' * ds.HASH_BLOCK_SIZE + 'b' * 10
+    tmpdir.join('f').write(data)
+    tmpdir.join('g').write(data)
+    digests = store.put_file(str(tmpdir.join('f')))
+    assert store.put_file(str(tmpdir.join('g'))) == digests
+    assert digests == [block('a' * ds.HASH_BLOCK_SIZE), block('b' * 10)]
+    assert ds.ChunkStore.content_hash(digests) == content_hash(data)
+    assert [store.get(digest) for digest in digests] == ['a' * ds.HASH_BLOCK_SIZE, 'b' * 10]
+    assert store.added == 2
+
+def test_release_removes_the_blocks_no_manifest_uses(ds, store, tmpdir):
+    first = write_snapshot(ds, store, tmpdir, 's1', {u'/a': 'shared', u'/b': 'old'})
+    second = write_snapshot(ds, store, tmpdir, 's2', {u'/b': 'new'}, previous=first)
+    assert stored_blocks(store) == sorted([block('shared'), block('old'), block('new')])
+    store.release(ds.Manifest.path_of(first), 's1')
+    assert stored_blocks(store) == sorted([block('shared'), block('new')])
+    store.release(ds.Manifest.path_of(second), 's2')
+    assert stored_blocks(store) == []
+
+def test_retain_counts_a_snapshot_once(ds, store, tmpdir):
+    snapshot = write_snapshot(ds, store, tmpdir, 's1', {u'/a': 'data'})
+    store.retain(ds.Manifest.path_of(snapshot), 's1')
+    store.release(ds.Manifest.path_of(snapshot), 's1')
+    assert stored_blocks(store) == []
+
+def test_sweep_removes_unused_blocks(ds, store, tmpdir):
+    write_snapshot(ds, store, tmpdir, 's1', {u'/a': 'used'})
+    store.put(block('unused'), 'unused')
+    store.put(block('kept'), 'kept')
+    store.sweep(keep=[block('kept')])
+    assert stored_blocks(store) == sorted([block('used'), block('kept')])
+
+def test_restore_snapshot(ds, store, tmpdir):
+    data = 'x' * ds.HASH_BLOCK_SIZE + 'y'
+    first = write_snapshot(ds, store, tmpdir, 's1', {u'/A/big': data, u'/A/gone': 'gone', u'/b': 'b1'})
+    write_snapshot(ds, store, tmpdir, 's2', {u'/A/gone': None, u'/b': 'b2', u'/C/new': ''}, previous=first)
+    target = tmpdir.join('restore')
+    ds.restore_snapshot(ds.Struct(folder=str(tmpdir)), 's2', str(target))
+    restored = dict((path.relto(target), path.read()) for path in target.visit(lambda p: p.check(file=1)))
+    assert restored == {'A/big': data, 'b': 'b2', 'C/new': ''}
+    assert datetime.datetime.utcfromtimestamp(target.join('b').mtime()) == MTIME
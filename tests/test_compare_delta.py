@@ -0,0 +1,79 @@
+import dropbox
+import pytest
+from dropbox.files import ListFolderContinueError, ListFolderResult
+
+from conftest import content_hash, deleted_entry, file_entry, folder_entry
+
+class FakeDropbox(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.cursors = []
+
+    def files_list_folder_continue(self, cursor):
+        self.cursors.append(cursor)
+        if self.entries is None:
+            raise dropbox.exceptions.ApiError('request', ListFolderContinueError.reset, None, None)
+        return ListFolderResult(entries=self.entries, cursor='next', has_more=False)
+
+@pytest.fixture
+def snapshot(ds, tmpdir, monkeypatch):
+    """ A snapshot in progress holding /A/keep, /A/mod, /A/gone and /A/sub/x, with the run state set up around it. """
+    root = tmpdir.mkdir('snapshot.incomplete')
+    for path, data in [('A/keep', 'keep'), ('A/mod', 'old'), ('A/gone', 'gone'), ('A/sub/x', 'x')]:
+        root.join(path).write(data, ensure=True)
+    monkeypatch.setattr(ds, 'hash_cache', ds.HashCache(str(tmpdir.join('hashes.db'))))
+    for path in root.visit(lambda p: p.check(file=1)):
+        ds.hash_cache.get(str(path))
+    monkeypatch.setattr(ds, 'journal', ds.JobJournal(str(tmpdir.join('snapshot.job'))))
+    ds.journal.header()
+    monkeypatch.setattr(ds, 'dedup_index', ds.DedupIndex(str(root), str(tmpdir.join('previous'))))
+    monkeypatch.setattr(ds, 'filters', ds.Filters())
+    monkeypatch.setattr(ds, 'compare_mode', 'hash')
+    monkeypatch.setattr(ds, 'total_count', 0)
+    monkeypatch.setattr(ds, 'listed_bytes', 0)
+    return root
+
+def planned(ds):
+    ds.journal.flush()
+    return [(record['op'], record['path']) for record in ds.JobJournal.read(ds.journal.path) if 'op' in record]
+
+def compare(ds, snapshot, entries, deferred=()):
+    return ds.compare_delta(FakeDropbox(entries), u'/A', unicode(snapshot) + u'/A', 'cursor', deferred)
+
+def test_modified_file(ds, snapshot):
+    assert compare(ds, snapshot, [file_entry(u'/A/mod', 'new'), file_entry(u'/A/keep', 'keep')]) == 'next'
+    assert planned(ds) == [('u', u'/A/mod')]
+
+def test_added_file(ds, snapshot):
+    compare(ds, snapshot, [file_entry(u'/A/new', 'new')])
+    assert planned(ds) == [('+', u'/A/new')]
+
+def test_deleted_file_and_folder(ds, snapshot):
+    compare(ds, snapshot, [deleted_entry(u'/A/gone'), deleted_entry(u'/A/sub'), deleted_entry(u'/A/never')])
+    assert planned(ds) == [('-', u'/A/gone'), ('-', u'/A/sub/')]
+
+def test_moved_folder_is_linked_from_the_previous_snapshot(ds, snapshot):
+    compare(ds, snapshot, [deleted_entry(u'/A/sub'), folder_entry(u'/A/Moved'), file_entry(u'/A/Moved/x', 'x')])
+    assert planned(ds) == [('-', u'/A/sub/'), ('+', u'/A/Moved/'), ('+', u'/A/Moved/x')]
+    previous = ds.dedup_index.snapshot_previous
+    assert ds.dedup_index.get(content_hash('x')) == previous + u'/A/sub/x'
+
+def test_changes_below_a_removed_folder_are_planned_again(ds, snapshot):
+    compare(ds, snapshot, [deleted_entry(u'/A/sub'), folder_entry(u'/A/sub'), file_entry(u'/A/sub/x', 'x')])
+    assert planned(ds) == [('-', u'/A/sub/'), ('+', u'/A/sub/'), ('+', u'/A/sub/x')]
+
+def test_filtered_change_is_removed(ds, snapshot):
+    ds.filters = ds.Filters(exclude=[u'mod'])
+    compare(ds, snapshot, [file_entry(u'/A/mod', 'new')])
+    assert planned(ds) == [('-', u'/A/mod')]
+    assert ds.filters.skipped == 1
+
+def test_deferred_file_is_planned_unless_changed(ds, snapshot):
+    deferred = [{'path': u'/A/later', 'size': 5, 'mtime': '2020-01-01T00:00:00Z', 'hash': 'h', 'rev': 'r'},
+        {'path': u'/A/sub/y', 'size': 5, 'mtime': '2020-01-01T00:00:00Z', 'hash': 'h', 'rev': 'r'}]
+    compare(ds, snapshot, [deleted_entry(u'/A/sub')], deferred)
+    assert planned(ds) == [('-', u'/A/sub/'), ('+', u'/A/later')]
+
+def test_reset_cursor(ds, snapshot):
+    assert compare(ds, snapshot, None) is None
+    assert planned(ds) == []
@@ -0,0 +1,62 @@
+import re
+
+from conftest import deleted_entry, file_entry, folder_entry
+
+def matches(ds, pattern, path):
+    return re.match(u'^(?:%s)(?:/.*)?$' % ds.Filters.translate(pattern), path) is not None
+
+def test_translate_name_matches_at_any_depth(ds):
+    assert matches(ds, u'node_modules', u'/node_modules')
+    assert matches(ds, u'node_modules', u'/a/b/node_modules/c.js')
+    assert not matches(ds, u'node_modules', u'/a/node_modules2')
+
+def test_translate_path_is_matched_from_the_root(ds):
+    assert matches(ds, u'/Photos/*.jpg', u'/photos/a.jpg')
+    assert not matches(ds, u'/Photos/*.jpg', u'/old/photos/a.jpg')
+
+def test_translate_star_stays_within_a_name(ds):
+    assert matches(ds, u'/a/*.txt', u'/a/x.txt')
+    assert not matches(ds, u'/a/*.txt', u'/a/b/x.txt')
+    assert matches(ds, u'/a/?.txt', u'/a/x.txt')
+    assert not matches(ds, u'/a/?.txt', u'/a/xy.txt')
+
+def test_translate_double_star_spans_folders(ds):
+    assert matches(ds, u'/Videos/**/*.mov', u'/videos/a.mov')
+    assert matches(ds, u'/Videos/**/*.mov', u'/videos/2020/jan/a.mov')
+    assert not matches(ds, u'/Videos/**/*.mov', u'/videos/a.mp4')
+
+def test_translate_character_class(ds):
+    assert matches(ds, u'/[ab].txt', u'/a.txt')
+    assert not matches(ds, u'/[!ab].txt', u'/a.txt')
+    assert matches(ds, u'/[!ab].txt', u'/c.txt')
+
+def test_exclude_covers_everything_below(ds):
+    filters = ds.Filters(exclude=[u'node_modules'])
+    assert not filters.wanted(folder_entry(u'/App/node_modules'))
+    assert not filters.wanted(file_entry(u'/App/node_modules/x/index.js'))
+    assert filters.wanted(file_entry(u'/App/index.js'))
+
+def test_include_keeps_the_folders_leading_to_it(ds):
+    filters = ds.Filters(include=[u'/Photos/2020'])
+    assert filters.wanted(folder_entry(u'/Photos'))
+    assert filters.wanted(folder_entry(u'/Photos/2020'))
+    assert filters.wanted(file_entry(u'/Photos/2020/a.jpg'))
+    assert not filters.wanted(file_entry(u'/Photos/a.jpg'))
+    assert not filters.wanted(folder_entry(u'/Photos/2019'))
+    assert not filters.wanted(folder_entry(u'/Music'))
+
+def test_max_size(ds):
+    filters = ds.Filters(max_size=1)
+    assert filters.wanted(file_entry(u'/small', 'x' * 1024))
+    assert not filters.wanted(file_entry(u'/big', 'x' * (1024*1024 + 1)))
+
+def test_deleted_entries_are_only_checked_against_excludes(ds):
+    filters = ds.Filters(include=[u'/Keep'], exclude=[u'*.tmp'])
+    assert filters.wanted(deleted_entry(u'/Other/a'))
+    assert not filters.wanted(deleted_entry(u'/Keep/a.tmp'))
+
+def test_filter_counts_the_skipped_entries(ds):
+    filters = ds.Filters(exclude=[u'*.tmp'])
+    kept = list(filters.filter([file_entry(u'/a.tmp'), file_entry(u'/b'), file_entry(u'/c.TMP')]))
+    assert [entry.path_display for entry in kept] == [u'/b']
+    assert filters.skipped == 2
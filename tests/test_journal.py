@@ -0,0 +1,75 @@
+import datetime
+
+import pytest
+
+def remote_file(ds, name, size=3):
+    return ds.RemoteFile(name, size, datetime.datetime(2020, 1, 2, 3, 4, 5), 'hash-' + name, 'rev-' + name)
+
+def write_job(ds, path):
+    journal = ds.JobJournal(path)
+    journal.header(snapshot='s')
+    journal.plan('+', u'/a/', None)
+    journal.plan('+', u'/a/f', remote_file(ds, 'f'))
+    journal.plan('u', u'/a/g', remote_file(ds, 'g'))
+    journal.done(0)
+    journal.done(2)
+    journal.scan(u'/a')
+    journal.plan('-', u'/a/old')
+    journal.close()
+
+def test_replay(ds, tmpdir):
+    path = str(tmpdir.join('s.job'))
+    write_job(ds, path)
+    header, done, plan, scanned = ds.JobJournal.replay(path)
+    assert header['snapshot'] == 's'
+    assert header['version'] == ds.JobJournal.VERSION
+    assert done == set([0, 2])
+    assert scanned == [u'/a']
+    plan = list(plan)
+    assert [(record['id'], record['op'], record['path']) for record in plan] == [
+        (0, '+', u'/a/'), (1, '+', u'/a/f'), (2, 'u', u'/a/g'), (3, '-', u'/a/old')]
+    assert plan[1]['size'] == 3
+    assert plan[1]['hash'] == 'hash-f'
+    assert plan[1]['mtime'] == '2020-01-02T03:04:05Z'
+
+def test_replay_with_a_spool_folder(ds, tmpdir):
+    path = str(tmpdir.join('s.job'))
+    write_job(ds, path)
+    header, done, plan, scanned = ds.JobJournal.replay(path, str(tmpdir))
+    assert [record['id'] in done for record in plan] == [True, False, True, False]
+
+def test_resume_appends_after_a_truncated_line(ds, tmpdir):
+    path = str(tmpdir.join('s.job'))
+    write_job(ds, path)
+    with open(path, 'ab') as f:
+        f.write('{"done":')
+    journal = ds.JobJournal(path)
+    journal.done(1)
+    journal.close()
+    header, done, plan, scanned = ds.JobJournal.replay(path)
+    assert done == set([0, 1, 2])
+    assert len(list(plan)) == 4
+
+def test_done_lines_keep_the_blocks(ds, tmpdir):
+    path = str(tmpdir.join('s.job'))
+    journal = ds.JobJournal(path)
+    journal.header()
+    journal.done(journal.plan('+', u'/f', remote_file(ds, 'f')), ['b1', 'b2'])
+    journal.close()
+    assert [record.get('blocks') for record in ds.JobJournal.read(path) if 'done' in record] == [['b1', 'b2']]
+
+def test_listener_sees_every_plan_record(ds, tmpdir):
+    journal = ds.JobJournal(str(tmpdir.join('s.job')))
+    seen = []
+    journal.listener = seen.append
+    journal.plan('+', u'/a/')
+    journal.done(0)
+    journal.plan('-', u'/b')
+    journal.close()
+    assert [record['path'] for record in seen] == [u'/a/', u'/b']
+
+def test_unsupported_version(ds, tmpdir):
+    path = tmpdir.join('s.job')
+    path.write('{"version":99}\n')
+    with pytest.raises(ValueError):
+        ds.JobJournal.replay(str(path))
@@ -0,0 +1,60 @@
+import datetime
+import os
+
+import pytest
+
+from conftest import content_hash
+
+@pytest.fixture
+def snapshots(ds, tmpdir, monkeypatch):
+    """ Three hardlinked snapshots: s2 removes /a, changes /b and adds /c, s3 changes nothing. """
+    monkeypatch.setattr(ds, 'hash_cache', ds.HashCache(str(tmpdir.join('hashes.db'))))
+    s1 = tmpdir.mkdir('s1')
+    for name in ['a', 'b', 'd']:
+        s1.join(name).write(name + '1')
+        ds.hash_cache.get(str(s1.join(name)))
+    write_manifest(ds, s1, None, [])
+    s2 = tmpdir.mkdir('s2')
+    os.link(str(s1.join('d')), str(s2.join('d')))
+    s2.join('b').write('b2')
+    s2.join('c').write('c2')
+    write_manifest(ds, s2, s1, [('-', u'/a', None), ('u', u'/b', 'b2'), ('+', u'/c', 'c2')])
+    s3 = tmpdir.mkdir('s3')
+    for name in ['b', 'c', 'd']:
+        os.link(str(s2.join(name)), str(s3.join(name)))
+    write_manifest(ds, s3, s2, [])
+    return str(tmpdir)
+
+def write_manifest(ds, snapshot, previous, changes):
+    journal = ds.JobJournal(str(snapshot) + '.job')
+    journal.header()
+    for op, path, data in changes:
+        item = data and ds.RemoteFile(path[1:], len(data), datetime.datetime(2020, 1, 1), content_hash(data), 'rev-' + data)
+        journal.plan(op, path, item)
+    journal.close()
+    ds.Manifest.write(str(snapshot), str(snapshot), previous and str(previous), str(snapshot) + '.job')
+
+def manifest(ds, folder, name):
+    return ds.Manifest.open(os.path.join(folder, name))
+
+def test_write_follows_the_journal(ds, snapshots):
+    rows = list(manifest(ds, snapshots, 's2').files())
+    assert rows == [(u'/b', 2, 'rev-b2', content_hash('b2')), (u'/c', 2, 'rev-c2', content_hash('c2')), (u'/d', 2, None, content_hash('d1'))]
+
+def test_diff(ds, snapshots):
+    assert list(manifest(ds, snapshots, 's1').diff(manifest(ds, snapshots, 's2'))) == [('-', u'/a'), ('u', u'/b'), ('+', u'/c')]
+    assert list(manifest(ds, snapshots, 's2').diff(manifest(ds, snapshots, 's3'))) == []
+    assert list(manifest(ds, snapshots, 's3').diff(manifest(ds, snapshots, 's1'))) == [('+', u'/a'), ('u', u'/b'), ('-', u'/c')]
+
+def test_find(ds, snapshots):
+    assert list(manifest(ds, snapshots, 's3').find(content_hash('d1')[:8])) == [u'/d']
+
+def history(ds, snapshots, path, capsys):
+    ds.query_manifests(ds.Struct(folder=snapshots), ds.Struct(diff=None, history=path, find=None))
+    return [line.split()[:3] for line in capsys.readouterr()[0].splitlines()]
+
+def test_history_joins_the_snapshots_of_a_version(ds, snapshots, capsys):
+    assert history(ds, snapshots, 'b', capsys) == [['s1', '..', 's1'], ['s2', '..', 's3']]
+    assert history(ds, snapshots, '/d', capsys) == [['s1', '..', 's3']]
+    assert history(ds, snapshots, '/a', capsys) == [['s1', '..', 's1']]
+    assert history(ds, snapshots, '/x', capsys) == [['Not', 'in', 'any']]
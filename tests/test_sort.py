@@ -0,0 +1,51 @@
+import random
+
+from conftest import file_entry, folder_entry
+
+def test_external_sort_merges_the_spilled_chunks(ds, tmpdir):
+    keys = range(20)
+    random.Random(1).shuffle(keys)
+    pairs = ds.ExternalSort(str(tmpdir), chunk_size=3)
+    for key in keys:
+        pairs.add(key, str(key))
+    assert len(pairs) == 20
+    assert list(pairs) == [(key, str(key)) for key in range(20)]
+
+def test_external_sort_keeps_the_order_of_equal_keys(ds, tmpdir):
+    pairs = ds.ExternalSort(str(tmpdir), chunk_size=2)
+    for value in ['a', 'b', 'c', 'd', 'e']:
+        pairs.add([u'k', 1], value)
+    pairs.add([u'j', 2], 'f')
+    assert list(pairs) == [([u'j', 2], 'f')] + [([u'k', 1], value) for value in ['a', 'b', 'c', 'd', 'e']]
+
+def test_sorted_remote_tree_walks_parents_first(ds, tmpdir):
+    entries = [
+        file_entry(u'/Root/Sub/Deep/f'),
+        folder_entry(u'/Root/Sub-2'),
+        file_entry(u'/Root/b.txt'),
+        folder_entry(u'/Root/Sub/Deep'),
+        file_entry(u'/Root/Sub/z'),
+        folder_entry(u'/Root/Sub'),
+        folder_entry(u'/Root/Gone/Inner'), # Its parent is not listed
+        file_entry(u'/Root/Gone/Inner/g'),
+        file_entry(u'/Root/A.txt'),
+        folder_entry(u'/Root'),
+    ]
+    tree = ds.SortedRemoteTree(u'/Root', str(tmpdir))
+    for entry in entries:
+        tree.add(entry)
+    walked = [(folder, children, [item.name for item in files]) for folder, children, files in tree.walk()]
+    assert walked == [
+        (u'/Root/', [u'Sub', u'Sub-2'], [u'A.txt', u'b.txt']),
+        (u'/Root/gone/Inner/', [], [u'g']),
+        (u'/Root/Sub/', [u'Deep'], [u'z']),
+        (u'/Root/Sub/Deep/', [], [u'f']),
+        (u'/Root/Sub-2/', [], []),
+    ]
+
+def test_sorted_remote_tree_keeps_the_file_metadata(ds, tmpdir):
+    entry = file_entry(u'/r/f', 'data')
+    tree = ds.SortedRemoteTree(u'/r', str(tmpdir))
+    tree.add(entry)
+    [(folder, children, [item])] = list(tree.walk())
+    assert item == ds.RemoteFile(u'f', 4, entry.client_modified, entry.content_hash, entry.rev)